@@ -1,13 +1,63 @@
 import sys
 import os
-from .parse_papers import parse_papers
+import argparse
+from .parse_papers import parse_papers, merge_shards, materialize_output
+from .replay import CacheMiss, REPLAY_MODES
 
 if __name__ == "__main__":
-    filename = sys.argv[1] if len(sys.argv) > 1 else "config.csv"
+    arg_parser = argparse.ArgumentParser(prog=f"python -m {__package__}")
+    arg_parser.add_argument("config", nargs="?", default="config.csv")
+    arg_parser.add_argument(
+        "--shard",
+        metavar="i/N",
+        help="only process the IDs in shard i of N (i counts from 0)",
+    )
+    arg_parser.add_argument(
+        "--merge",
+        metavar="N",
+        type=int,
+        help="merge the outputs of N shards into the final output",
+    )
+    arg_parser.add_argument(
+        "--materialize",
+        action="store_true",
+        help="write the csv and json outputs from the log of finished documents",
+    )
+    arg_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the IDs already in the output log of an earlier run",
+    )
+    arg_parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="resume, running the IDs that failed again",
+    )
+    arg_parser.add_argument(
+        "--replay",
+        choices=REPLAY_MODES,
+        help="run only from the caches, failing or marking the replies on a cache miss",
+    )
+    args = arg_parser.parse_args()
+    filename = args.config
 
     if not os.path.isfile(filename):
         print(f"Error: config file '{filename}' not found.")
         print(f"Usage: python -m {__package__} <config.csv>")
         sys.exit(1)
 
-    parse_papers(filename)
+    if args.merge:
+        merge_shards(filename, args.merge)
+    elif args.materialize:
+        materialize_output(filename, shard=args.shard)
+    else:
+        try:
+            parse_papers(
+                filename,
+                shard=args.shard,
+                replay=args.replay,
+                resume=args.resume,
+                retry_failed=args.retry_failed,
+            )
+        except CacheMiss:
+            sys.exit(1)
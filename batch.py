@@ -0,0 +1,32 @@
+import threading
+from typing import List, Dict, Any
+
+
+class BatchPending(Exception):
+    """Raised by an engine when a prompt was queued for the next batch."""
+
+
+class BatchCollector:
+    """
+    Collects the prompts that missed the cache during one batch stage.
+    Engines with a batch_collector set queue the request here and raise
+    BatchPending instead of calling the API.
+    """
+
+    def __init__(self):
+        self.requests: List[Dict[str, Any]] = []
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def add(self, system: str, prompt: str, messages: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            # identical prompts from different documents are only sent once
+            if (system, prompt) in self._seen:
+                return
+            self._seen.add((system, prompt))
+            self.requests.append(
+                {"system": system, "prompt": prompt, "messages": messages}
+            )
+
+    def __len__(self) -> int:
+        return len(self.requests)
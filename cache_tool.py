@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Iterable, List, Tuple
+
+from .model_data import ModelDataLoader
+from .prompt_cache_sqlite import PromptCache, COMPRESSION_FORMATS
+from .document_store import DocumentStore
+from .id_source import IdSource
+from .utils import parse_size
+
+
+def open_cache(target: str, compression: Optional[str] = None):
+    """
+    Opens the SQLite prompt cache given a config file, a cache folder or the
+    database file itself. Returns the cache and the loaded config, if any.
+    compression defaults to cache_compression in the config, or zlib.
+    """
+    if target.endswith(".db"):
+        folder, filename = os.path.split(target)
+        return PromptCache(folder or ".", filename, compression or "zlib"), None
+    if os.path.isdir(target):
+        return PromptCache(target, compression=compression or "zlib"), None
+    model_data = ModelDataLoader()
+    model_data.load_model_data(target)
+    cache_folder = model_data.get("cache_folder", model_data.resolve_path("cache/api"))
+    if compression is None:
+        compression = model_data.get("cache_compression", "zlib")
+    return PromptCache(cache_folder, compression=compression), model_data
+
+
+def days_ago(days: float) -> str:
+    # Same format as the CURRENT_TIMESTAMP dates stored by SQLite
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_date(text: str) -> str:
+    # "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS", in UTC like the stored dates
+    try:
+        date = datetime.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{text}', use YYYY-MM-DD")
+    return date.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def file_date(path: str) -> str:
+    modified = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+    return modified.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def read_id_list(path: str, model_data=None) -> IdSource:
+    """IDs from any documents_data format, in the config's column_name column."""
+    column = model_data.get("column_name") if model_data is not None else None
+    return IdSource(path, column)
+
+
+def open_documents(model_data):
+    """Returns the data cache folder of the config and its DocumentStore, if it uses one."""
+    # same settings as WorkflowContext
+    data_folder = model_data.get(
+        "self_data.data_cache_folder", model_data.resolve_path("cache/data")
+    )
+    if str(model_data.get("document_store", "files")).lower() == "sqlite":
+        return data_folder, DocumentStore(data_folder)
+    return data_folder, None
+
+
+def export_documents(model_data, bundle_path: str, document_ids: Iterable[str]) -> int:
+    data_folder, store = open_documents(model_data)
+    if store is not None:
+        return store.export_bundle(bundle_path, document_ids)
+    # one JSON file per document, dated by its modification time
+    bundle = DocumentStore(*os.path.split(os.path.abspath(bundle_path)))
+    exported = 0
+    for document_id in document_ids:
+        path = os.path.join(data_folder, f"{document_id}.json")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as json_file:
+                bundle.put_raw(document_id, json.load(json_file), file_date(path))
+            exported += 1
+    return exported
+
+
+def import_documents(model_data, bundle_path: str) -> Tuple[int, int]:
+    data_folder, store = open_documents(model_data)
+    if store is not None:
+        return store.import_bundle(bundle_path)
+    os.makedirs(data_folder, exist_ok=True)
+    bundle = DocumentStore(*os.path.split(os.path.abspath(bundle_path)))
+    added = replaced = 0
+    for document_id, data, date in bundle.items():
+        path = os.path.join(data_folder, f"{document_id}.json")
+        exists = os.path.exists(path)
+        if exists and file_date(path) >= date:
+            continue
+        with open(path, "w", encoding="utf-8") as json_file:
+            json.dump(data, json_file, ensure_ascii=False, indent=4)
+        if exists:
+            replaced += 1
+        else:
+            added += 1
+    return added, replaced
+
+
+def linked_documents(bundle_path: str) -> List[str]:
+    """The documents the responses in a bundle were used for."""
+    conn = sqlite3.connect(bundle_path)
+    try:
+        return [
+            row[0]
+            for row in conn.execute("SELECT DISTINCT document FROM cache_documents")
+        ]
+    finally:
+        conn.close()
+
+
+def format_size(size: int) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def print_stats(cache: PromptCache) -> None:
+    stats = cache.statistics()
+    print(
+        f"{stats['entries']} responses, {format_size(stats['bytes'])} stored, "
+        f"{format_size(stats['file_bytes'])} on disk ({cache.db_path})"
+    )
+    if stats["formats"]:
+        print(
+            "  stored as "
+            + ", ".join(f"{name}: {count}" for name, count in stats["formats"].items())
+        )
+    for model_engine, model in stats["models"].items():
+        print(
+            f"  {model_engine}: {model['entries']} responses, "
+            f"{format_size(model['bytes'])}, saved {model['oldest']} to "
+            f"{model['newest']}, last used {model['last_access']}"
+        )
+
+
+def main(argv=None) -> None:
+    arg_parser = argparse.ArgumentParser(
+        prog=f"python -m {__package__}.cache_tool",
+        description="Maintenance of the SQLite prompt cache.",
+    )
+    arg_parser.add_argument(
+        "target",
+        nargs="?",
+        default="config.csv",
+        help="config file, cache folder or api_cache.db file",
+    )
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="show the size of the cache, per model")
+    prune = commands.add_parser("prune", help="remove old or unwanted responses")
+    prune.add_argument(
+        "--older-than", type=float, metavar="DAYS", help="saved more than DAYS ago"
+    )
+    prune.add_argument(
+        "--unused-for", type=float, metavar="DAYS", help="not used for DAYS"
+    )
+    prune.add_argument(
+        "--model", metavar="PATTERN", help="model name, %% matches anything"
+    )
+    cap = commands.add_parser(
+        "cap", help="remove the least recently used responses above a size"
+    )
+    cap.add_argument(
+        "size", nargs="?", help="e.g. 10GB, defaults to cache_max_size in the config"
+    )
+    commands.add_parser("vacuum", help="compact the database file")
+    migrate = commands.add_parser(
+        "migrate", help="rewrite the stored responses in one compression format"
+    )
+    migrate.add_argument(
+        "--compression",
+        choices=list(COMPRESSION_FORMATS),
+        help="defaults to cache_compression in the config, or zlib",
+    )
+    export = commands.add_parser(
+        "export",
+        help="write the responses and documents matching the filters to a bundle file",
+    )
+    export.add_argument("bundle", help="bundle file to write, replaced if it exists")
+    export.add_argument(
+        "--ids",
+        metavar="FILE",
+        help="only responses used for these documents, listed like documents_data",
+    )
+    export.add_argument(
+        "--model", metavar="PATTERN", help="model name, %% matches anything"
+    )
+    export.add_argument(
+        "--since", type=parse_date, metavar="DATE", help="saved on or after DATE"
+    )
+    export.add_argument(
+        "--until", type=parse_date, metavar="DATE", help="saved before DATE"
+    )
+    import_ = commands.add_parser(
+        "import", help="merge a bundle file, keeping the newer of two responses"
+    )
+    import_.add_argument("bundle", help="bundle file written by export")
+    args = arg_parser.parse_args(argv)
+
+    if not os.path.exists(args.target):
+        print(f"Error: '{args.target}' not found.")
+        sys.exit(1)
+    try:
+        cache, model_data = open_cache(args.target, getattr(args, "compression", None))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    if args.command == "stats":
+        print_stats(cache)
+    elif args.command == "prune":
+        if args.older_than is None and args.unused_for is None and not args.model:
+            arg_parser.error("prune needs --older-than, --unused-for or --model")
+        removed = cache.prune(
+            created_before=(
+                days_ago(args.older_than) if args.older_than is not None else None
+            ),
+            accessed_before=(
+                days_ago(args.unused_for) if args.unused_for is not None else None
+            ),
+            model_engine=args.model,
+        )
+        print(f"Removed {removed} responses.")
+    elif args.command == "cap":
+        size = args.size
+        if size is None and model_data is not None:
+            size = model_data.get("cache_max_size")
+        if size is None:
+            arg_parser.error("cap needs a size, or cache_max_size in the config")
+        removed = cache.enforce_size_limit(parse_size(size))
+        print(f"Removed {removed} responses.")
+    elif args.command == "vacuum":
+        before = cache.file_size()
+        cache.vacuum()
+        print(f"Compacted {format_size(before)} to {format_size(cache.file_size())}.")
+    elif args.command == "migrate":
+        rewritten = cache.recompress()
+        print(f"Rewrote {rewritten} responses, run vacuum to reclaim the space.")
+    elif args.command == "export":
+        document_ids = None
+        if args.ids:
+            document_ids = read_id_list(args.ids, model_data)
+        if os.path.exists(args.bundle):
+            os.remove(args.bundle)
+        exported = cache.export_bundle(
+            args.bundle,
+            documents=document_ids,
+            model_engine=args.model,
+            created_after=args.since,
+            created_before=args.until,
+        )
+        print(f"Exported {exported} responses to {args.bundle}.")
+        if model_data is not None:
+            if document_ids is None:
+                document_ids = linked_documents(args.bundle)
+            exported = export_documents(model_data, args.bundle, document_ids)
+            print(f"Exported {exported} documents.")
+    elif args.command == "import":
+        if not os.path.exists(args.bundle):
+            print(f"Error: '{args.bundle}' not found.")
+            sys.exit(1)
+        added, replaced = cache.import_bundle(args.bundle)
+        print(f"Imported {added} new responses, replaced {replaced} older ones.")
+        if model_data is not None:
+            added, replaced = import_documents(model_data, args.bundle)
+            print(f"Imported {added} new documents, replaced {replaced} older ones.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import re
+import importlib
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .utils import estimate_tokens, CHARS_PER_TOKEN
+from .prompt_template import PromptTemplate
+
+DEFAULT_OVERLAP = 500  # characters
+# Sentence ends and paragraph breaks, the text is only cut after these
+BOUNDARY_RE = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+WORD_RE = re.compile(r"\S+\s*|\s+")
+
+
+def get_tokenizer(name: Optional[str] = None, model_name=None) -> Callable[[str], int]:
+    """
+    Returns a function counting the tokens of a text:
+    heuristic (default) estimates them from the length, chars counts characters,
+    tiktoken or tiktoken:<encoding> uses tiktoken, and module:function imports
+    any other counting function.
+    """
+    name = str(name or "heuristic")
+    if name.lower() == "heuristic":
+        return estimate_tokens
+    if name.lower() == "chars":
+        return len
+    if name.lower().split(":")[0] == "tiktoken":
+        try:
+            import tiktoken
+        except ModuleNotFoundError as e:
+            raise ValueError(
+                "To use the tiktoken tokenizer tiktoken must be installed"
+            ) from e
+        encoding_name = name.partition(":")[2]
+        if encoding_name:
+            encoding = tiktoken.get_encoding(encoding_name)
+        else:
+            try:
+                encoding = tiktoken.encoding_for_model(str(model_name))
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    if ":" in name:
+        module_name, _, function_name = name.partition(":")
+        return getattr(importlib.import_module(module_name), function_name)
+    raise ValueError(
+        f"Unknown tokenizer '{name}', use heuristic, chars, tiktoken or module:function"
+    )
+
+
+class Chunker:
+    """
+    Splits prompts that are too long for the model.  The longest value filled
+    into the prompt is cut in one pass at sentence or paragraph boundaries
+    into as few chunks as fit in max_size, each starting with up to overlap
+    of the end of the previous one.  Sizes are counted with count, in tokens
+    or characters.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        overlap: int = DEFAULT_OVERLAP,
+        count: Callable[[str], int] = len,
+    ):
+        self.max_size = max_size
+        self.overlap = overlap
+        self.count = count
+
+    @classmethod
+    def from_config(cls, model_data, max_prompt_length: int) -> "Chunker":
+        """
+        max_prompt_tokens limits prompts in tokens counted with tokenizer,
+        otherwise max_prompt_length limits them in characters.
+        chunk_overlap is in the same unit.
+        """
+        max_tokens = model_data.get("max_prompt_tokens")
+        if max_tokens:
+            count = get_tokenizer(
+                model_data.get("tokenizer"), model_data.get("model_name")
+            )
+            overlap = int(
+                model_data.get("chunk_overlap", DEFAULT_OVERLAP // CHARS_PER_TOKEN)
+            )
+            if count is estimate_tokens:
+                # the estimate only depends on the length, so split in
+                # characters, adding up the estimates of each word would
+                # count one token too many per word
+                return cls(
+                    int(max_tokens) * CHARS_PER_TOKEN - 1,
+                    overlap * CHARS_PER_TOKEN,
+                    len,
+                )
+            return cls(int(max_tokens), overlap, count)
+        overlap = model_data.get("chunk_overlap", DEFAULT_OVERLAP)
+        return cls(max_prompt_length, int(overlap), len)
+
+    def with_limit(self, max_size: int) -> "Chunker":
+        return Chunker(max_size, self.overlap, self.count)
+
+    def truncate(self, text: str, max_size: int) -> str:
+        if self.count is len:
+            return text[:max_size]
+        size = self.count(text)
+        while size > max_size:
+            text = text[: int(len(text) * max_size / size * 0.95)]
+            size = self.count(text)
+        return text
+
+    def chunk(self, template: PromptTemplate, values: Dict[str, str]) -> List[str]:
+        """Renders the template, split into several prompts if it is too long."""
+        rendered = template.render(values)
+        if self.count(rendered) <= self.max_size:
+            return [rendered]
+
+        occurrences = template.occurrences(values)
+        if not occurrences:
+            # If no substitutions but still too long, simply truncate
+            return [self.truncate(rendered, self.max_size)]
+
+        # Only the longest value is split, the rest of the prompt is repeated
+        name, text = max(occurrences, key=lambda x: len(x[1]))
+        repeats = sum(1 for other, _ in occurrences if other == name)
+        fixed = self.count(template.render({**values, name: ""}))
+        budget = (self.max_size - fixed) // repeats
+
+        if budget <= self.overlap:
+            # Too little room left to split meaningfully, truncate the result
+            return [self.truncate(rendered, self.max_size)]
+
+        return [
+            template.render({**values, name: part})
+            for part in self.split_text(text, budget)
+        ]
+
+    def segments(self, text: str, budget: int):
+        """Yields (segment, size) of the sentences and paragraphs of text,
+        with segments longer than budget cut at word boundaries."""
+        start = 0
+        for match in BOUNDARY_RE.finditer(text):
+            yield from self._fit(text[start : match.end()], budget)
+            start = match.end()
+        if start < len(text):
+            yield from self._fit(text[start:], budget)
+
+    def _fit(self, segment: str, budget: int):
+        size = self.count(segment)
+        if size <= budget:
+            yield segment, size
+            return
+        piece, piece_size = "", 0
+        for word in WORD_RE.findall(segment):
+            word_size = self.count(word)
+            while word_size > budget:
+                # a single word longer than the budget is cut anywhere
+                cut = max(1, len(word) * budget // word_size)
+                if piece:
+                    yield piece, piece_size
+                    piece, piece_size = "", 0
+                yield word[:cut], self.count(word[:cut])
+                word = word[cut:]
+                word_size = self.count(word)
+            if piece and piece_size + word_size > budget:
+                yield piece, piece_size
+                piece, piece_size = "", 0
+            piece += word
+            piece_size += word_size
+        if piece:
+            yield piece, piece_size
+
+    def tail(self, text: str, max_size: int) -> Tuple[str, int]:
+        """Returns the end of text that fits in max_size, in whole words if
+        the last word fits, otherwise in characters, and its size."""
+        tail, tail_size = "", 0
+        for word in reversed(WORD_RE.findall(text)):
+            word_size = self.count(word)
+            if tail_size + word_size > max_size:
+                break
+            tail = word + tail
+            tail_size += word_size
+        if tail or max_size <= 0:
+            return tail, tail_size
+        size = self.count(text)
+        cut = len(text) * max_size // size
+        while cut > 0 and self.count(text[-cut:]) > max_size:
+            cut = int(cut * 0.95)
+        if cut <= 0:
+            return "", 0
+        return text[-cut:], self.count(text[-cut:])
+
+    def split_text(self, text: str, budget: int) -> List[str]:
+        """Packs the segments of text greedily into chunks of at most budget."""
+        chunks = []
+        current = deque()
+        current_size = 0
+        # long segments are cut to leave room for the overlap before them
+        for segment, size in self.segments(text, max(1, budget - self.overlap)):
+            if current and current_size + size > budget:
+                chunks.append("".join(part for part, _ in current))
+                # the next chunk repeats the last segments, up to overlap
+                kept = deque()
+                kept_size = 0
+                for part, part_size in reversed(current):
+                    if kept_size + part_size > self.overlap:
+                        break
+                    kept.appendleft((part, part_size))
+                    kept_size += part_size
+                if not kept:
+                    # the last segment is longer than overlap, repeat its end
+                    tail, tail_size = self.tail(current[-1][0], self.overlap)
+                    if tail:
+                        kept.append((tail, tail_size))
+                        kept_size = tail_size
+                current, current_size = kept, kept_size
+                while current and current_size + size > budget:
+                    current_size -= current.popleft()[1]
+            current.append((segment, size))
+            current_size += size
+        if current:
+            chunks.append("".join(part for part, _ in current))
+        return chunks
@@ -1,5 +1,7 @@
 import os
-from typing import Optional, List, Dict, Any
+import time
+import inspect
+from typing import Optional, List, Dict, Any, Tuple
 
 try:
     import anthropic
@@ -16,8 +18,11 @@ except ModuleNotFoundError:
     RETRY_EXCEPTIONS = ()
     ANTHROPIC_AVAILABLE = False
 
-from .prompt_cache_sqlite import PromptCache
-from .retry import retry
+from .prompt_cache_memory import make_prompt_cache
+from .retry import retry, aretry
+from .batch import BatchPending
+from .rate_limit import get_rate_limiter
+from .utils import estimate_tokens, build_messages, UsageCounter
 
 
 class ClaudeEngine:
@@ -41,50 +46,212 @@ class ClaudeEngine:
         self.model_engine = model_data.get("model_name")
         self.max_tokens = max_tokens
         self.client = anthropic.Anthropic(api_key=key, base_url=api_url)
+        self.async_client = anthropic.AsyncAnthropic(api_key=key, base_url=api_url)
         self.cache_folder = cache_folder
-        self.cache = PromptCache(cache_folder)  # Use the imported cache class
+        self.cache = make_prompt_cache(model_data, cache_folder)
+        # Set to a BatchCollector to queue uncached prompts instead of sending them
+        self.batch_collector = None
+        # Set to a Replay to answer only from the cache
+        self.replay = None
+        self.batch_poll_interval = float(model_data.get("batch_poll_interval", 60))
+        # Shared with every engine calling the same model
+        self.rate_limiter = get_rate_limiter(
+            ("claude", api_url, self.model_engine),
+            model_data.get("requests_per_minute"),
+            model_data.get("tokens_per_minute"),
+        )
+        # Token usage reported by the API, including prompt caching
+        self.usage = UsageCounter()
 
-    def prompt(self, prompt: str, system: str = "") -> str:
-        messages = [
-            {"role": "system", "content": system},
-            {"role": "user", "content": prompt},
-        ]
+    def prompt(self, prompt: str, system: str = "", prefix: str = "") -> str:
+        messages = build_messages(prompt, system, prefix)
         response = self.create_chat_completion(messages)
         return response["choices"][0]["message"]["content"]
 
-    # This is used for API compatibility
-    @retry(exceptions=RETRY_EXCEPTIONS)
-    def create_chat_completion(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    async def aprompt(self, prompt: str, system: str = "", prefix: str = "") -> str:
+        messages = build_messages(prompt, system, prefix)
+        response = await self.acreate_chat_completion(messages)
+        return response["choices"][0]["message"]["content"]
+
+    @staticmethod
+    def _split_messages(
+        messages: List[Dict[str, str]],
+    ) -> Tuple[str, List[Dict[str, str]], str]:
+        # Claude takes the system prompt separately from the chat messages
         system_msg = "".join(m["content"] for m in messages if m["role"] == "system")
 
-        chat_messages = [
-            {"role": m["role"], "content": m["content"]}
-            for m in messages
-            if m["role"] != "system"
-        ]
+        chat_messages = []
+        for m in messages:
+            if m["role"] == "system":
+                continue
+            if chat_messages and chat_messages[-1]["role"] == m["role"] == "user":
+                # A document prefix and the prompt after it go in one message,
+                # with the prefix marked for prompt caching
+                previous = chat_messages[-1]
+                if isinstance(previous["content"], str):
+                    previous["content"] = [
+                        {"type": "text", "text": previous["content"]}
+                    ]
+                previous["content"][-1]["cache_control"] = {"type": "ephemeral"}
+                previous["content"].append({"type": "text", "text": m["content"]})
+            else:
+                chat_messages.append({"role": m["role"], "content": m["content"]})
 
-        system = system_msg
-        prompt = "".join(m["content"] for m in chat_messages if m["role"] == "user")
+        prompt = "".join(m["content"] for m in messages if m["role"] == "user")
+        return system_msg, chat_messages, prompt
 
-        cached = self.cache.get_cached_response(self.model_engine, system, prompt)
-        if cached:
-            return {"choices": [cached]}
+    @staticmethod
+    def _used_tokens(response) -> Optional[int]:
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return None
+        return usage.input_tokens + usage.output_tokens
 
-        response = self.client.messages.create(
-            model=self.model_engine,
-            system=system_msg,
-            messages=chat_messages,
-            max_tokens=self.max_tokens,
-        )
+    def _record_usage(self, response) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.usage.add(
+                input=usage.input_tokens,
+                output=usage.output_tokens,
+                cache_read=getattr(usage, "cache_read_input_tokens", None),
+                cache_write=getattr(usage, "cache_creation_input_tokens", None),
+            )
 
-        text = response.content[0].text
-        wrapped = {
+    @staticmethod
+    def _wrap(text: str) -> Dict[str, Any]:
+        return {
             "message": {
                 "role": "assistant",
                 "content": text,
             }
         }
 
+    # This is used for API compatibility
+    @retry(exceptions=RETRY_EXCEPTIONS)
+    def create_chat_completion(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        system, chat_messages, prompt = self._split_messages(messages)
+
+        cached = self.cache.get_cached_response(self.model_engine, system, prompt)
+        if self.replay is not None:
+            # offline replay never calls the model
+            cached = self.replay.check(self.model_engine, prompt, cached)
+        if cached:
+            return {"choices": [cached]}
+
+        if self.batch_collector is not None:
+            self.batch_collector.add(system, prompt, messages)
+            raise BatchPending(f"{self.model_engine} prompt queued for batch")
+
+        tokens = estimate_tokens(system + prompt)
+        self.rate_limiter.acquire(tokens)
+        try:
+            raw = self.client.messages.with_raw_response.create(
+                model=self.model_engine,
+                system=system,
+                messages=chat_messages,
+                max_tokens=self.max_tokens,
+            )
+        except anthropic.RateLimitError as e:
+            self.rate_limiter.update_from_headers(e.response.headers, tokens)
+            raise
+        except Exception:
+            self.rate_limiter.release(tokens)
+            raise
+        self.rate_limiter.update_from_headers(raw.headers, tokens)
+        response = raw.parse()
+        self.rate_limiter.settle(tokens, self._used_tokens(response))
+        self._record_usage(response)
+
+        wrapped = self._wrap(response.content[0].text)
+
         # Save response to cache
         self.cache.save_response(self.model_engine, system, prompt, wrapped)
         return {"choices": [wrapped]}
+
+    @aretry(exceptions=RETRY_EXCEPTIONS)
+    async def acreate_chat_completion(
+        self, messages: List[Dict[str, str]]
+    ) -> Dict[str, Any]:
+        system, chat_messages, prompt = self._split_messages(messages)
+
+        cached = await self.cache.aget_cached_response(
+            self.model_engine, system, prompt
+        )
+        if self.replay is not None:
+            # offline replay never calls the model
+            cached = self.replay.check(self.model_engine, prompt, cached)
+        if cached:
+            return {"choices": [cached]}
+
+        if self.batch_collector is not None:
+            self.batch_collector.add(system, prompt, messages)
+            raise BatchPending(f"{self.model_engine} prompt queued for batch")
+
+        tokens = estimate_tokens(system + prompt)
+        await self.rate_limiter.aacquire(tokens)
+        try:
+            raw = await self.async_client.messages.with_raw_response.create(
+                model=self.model_engine,
+                system=system,
+                messages=chat_messages,
+                max_tokens=self.max_tokens,
+            )
+        except anthropic.RateLimitError as e:
+            self.rate_limiter.update_from_headers(e.response.headers, tokens)
+            raise
+        except Exception:
+            self.rate_limiter.release(tokens)
+            raise
+        self.rate_limiter.update_from_headers(raw.headers, tokens)
+        response = raw.parse()
+        if inspect.isawaitable(response):
+            # newer anthropic releases parse async raw responses asynchronously
+            response = await response
+        self.rate_limiter.settle(tokens, self._used_tokens(response))
+        self._record_usage(response)
+
+        wrapped = self._wrap(response.content[0].text)
+
+        await self.cache.asave_response(self.model_engine, system, prompt, wrapped)
+        return {"choices": [wrapped]}
+
+    def run_batch(self, requests: List[Dict[str, Any]]) -> int:
+        """
+        Sends the requests as one Message Batch, waits for it to end and
+        saves the replies to the cache.  Returns the number of replies saved.
+        """
+        batch_requests = []
+        for i, request in enumerate(requests):
+            system, chat_messages, _ = self._split_messages(request["messages"])
+            batch_requests.append(
+                {
+                    "custom_id": f"request-{i}",
+                    "params": {
+                        "model": self.model_engine,
+                        "system": system,
+                        "messages": chat_messages,
+                        "max_tokens": self.max_tokens,
+                    },
+                }
+            )
+
+        batch = self.client.messages.batches.create(requests=batch_requests)
+        print(f"Submitted batch {batch.id} with {len(batch_requests)} requests")
+        while batch.processing_status != "ended":
+            time.sleep(self.batch_poll_interval)
+            batch = self.client.messages.batches.retrieve(batch.id)
+
+        saved = 0
+        for entry in self.client.messages.batches.results(batch.id):
+            if entry.result.type != "succeeded":
+                print(f"Batch request {entry.custom_id}: {entry.result.type}")
+                continue
+
+            request = requests[int(entry.custom_id.split("-")[1])]
+            wrapped = self._wrap(entry.result.message.content[0].text)
+            self.cache.save_response(
+                self.model_engine, request["system"], request["prompt"], wrapped
+            )
+            saved += 1
+
+        return saved
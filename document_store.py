@@ -0,0 +1,222 @@
+import os
+import json
+import zlib
+import sqlite3
+import threading
+from itertools import islice
+from typing import Optional, Dict, Any, Iterable, Iterator, Set, Tuple
+
+# Same settings as the prompt cache, see prompt_cache_sqlite.py
+BUSY_TIMEOUT = 30
+MMAP_SIZE = 256 * 1024 * 1024
+ZLIB_LEVEL = 6
+# Largest number of IDs in one query of existing_ids
+QUERY_BATCH = 500
+
+
+class DocumentStore:
+    """
+    Keeps fetched documents in one SQLite file instead of a JSON file per ID.
+    The raw payload (BioC JSON or the extracted local text) and the parsed
+    {"text", "sections"} for each set of sections are stored separately,
+    both zlib-compressed, so warm runs skip the parsing as well as the fetch.
+    """
+
+    def __init__(self, data_folder: str = "cache/data", filename="documents.db"):
+        os.makedirs(data_folder, exist_ok=True)
+        self.db_path = os.path.join(data_folder, filename)
+        self._local = threading.local()
+        self._initialize_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            self._local.conn = conn
+        return conn
+
+    def _initialize_db(self) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS raw (
+                    id TEXT PRIMARY KEY,
+                    data BLOB,
+                    date TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS parsed (
+                    id TEXT,
+                    sections TEXT,
+                    data BLOB,
+                    PRIMARY KEY (id, sections)
+                )
+            """
+            )
+
+    @staticmethod
+    def _sections_key(sections_to_extract) -> str:
+        return json.dumps(sections_to_extract, sort_keys=True)
+
+    @staticmethod
+    def _encode(data: Any) -> bytes:
+        return zlib.compress(json.dumps(data).encode(), ZLIB_LEVEL)
+
+    @staticmethod
+    def _decode(value: bytes) -> Any:
+        return json.loads(zlib.decompress(value))
+
+    def get_raw(self, document_id: str) -> Optional[Any]:
+        row = (
+            self._connect()
+            .execute("SELECT data FROM raw WHERE id = ?", (document_id,))
+            .fetchone()
+        )
+        return self._decode(row[0]) if row else None
+
+    def put_raw(self, document_id: str, data: Any, date: Optional[str] = None) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO raw (id, data, date)"
+                " VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+                (document_id, self._encode(data), date),
+            )
+            # parsed versions of an older payload are out of date
+            conn.execute("DELETE FROM parsed WHERE id = ?", (document_id,))
+
+    def get_parsed(
+        self, document_id: str, sections_to_extract
+    ) -> Optional[Dict[str, Any]]:
+        row = (
+            self._connect()
+            .execute(
+                "SELECT data FROM parsed WHERE id = ? AND sections = ?",
+                (document_id, self._sections_key(sections_to_extract)),
+            )
+            .fetchone()
+        )
+        return self._decode(row[0]) if row else None
+
+    def put_parsed(
+        self, document_id: str, sections_to_extract, parsed_data: Dict[str, Any]
+    ) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO parsed (id, sections, data) VALUES (?, ?, ?)",
+                (
+                    document_id,
+                    self._sections_key(sections_to_extract),
+                    self._encode(parsed_data),
+                ),
+            )
+
+    def existing_ids(self, document_ids: Iterable[str]) -> Set[str]:
+        """The IDs, out of document_ids, whose raw payload is stored."""
+        document_ids = iter(document_ids)
+        conn = self._connect()
+        found = set()
+        while True:
+            batch = list(islice(document_ids, QUERY_BATCH))
+            if not batch:
+                return found
+            placeholders = ",".join("?" * len(batch))
+            found.update(
+                row[0]
+                for row in conn.execute(
+                    f"SELECT id FROM raw WHERE id IN ({placeholders})", batch
+                )
+            )
+
+    def items(self) -> Iterator[Tuple[str, Any, str]]:
+        """Yields the id, raw payload and date of every stored document."""
+        for document_id, value, date in self._connect().execute(
+            "SELECT id, data, date FROM raw ORDER BY id"
+        ):
+            yield document_id, self._decode(value), date
+
+    def export_bundle(self, bundle_path: str, document_ids: Iterable[str]) -> int:
+        """
+        Copies the raw payloads of document_ids into the raw table of the
+        SQLite file bundle_path, see cache_tool export.  Returns the number
+        of documents exported.
+        """
+        conn = self._connect()
+        conn.execute("ATTACH DATABASE ? AS bundle", (bundle_path,))
+        try:
+            with conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS bundle.raw (
+                        id TEXT PRIMARY KEY,
+                        data BLOB,
+                        date TEXT DEFAULT CURRENT_TIMESTAMP
+                    )
+                """
+                )
+                conn.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS export_ids (id TEXT PRIMARY KEY)"
+                )
+                conn.execute("DELETE FROM temp.export_ids")
+                conn.executemany(
+                    "INSERT OR IGNORE INTO temp.export_ids VALUES (?)",
+                    ((str(document_id),) for document_id in document_ids),
+                )
+                cursor = conn.execute(
+                    """
+                    INSERT OR REPLACE INTO bundle.raw (id, data, date)
+                    SELECT id, data, date FROM main.raw
+                    WHERE id IN (SELECT id FROM temp.export_ids)
+                """
+                )
+        finally:
+            conn.execute("DETACH DATABASE bundle")
+        return cursor.rowcount
+
+    def import_bundle(self, bundle_path: str) -> Tuple[int, int]:
+        """
+        Merges the raw payloads of a bundle into the store.  A stored
+        document is replaced only if the bundle's copy is newer.  Returns the
+        numbers of documents added and replaced.
+        """
+        conn = self._connect()
+        conn.execute("ATTACH DATABASE ? AS bundle", (bundle_path,))
+        try:
+            tables = conn.execute(
+                "SELECT name FROM bundle.sqlite_master WHERE name = 'raw'"
+            ).fetchall()
+            if not tables:
+                return 0, 0
+            with conn:
+                changed = conn.execute(
+                    """
+                    SELECT b.id, m.id IS NULL FROM bundle.raw b
+                    LEFT JOIN main.raw m ON m.id = b.id
+                    WHERE m.id IS NULL OR b.date > m.date
+                """
+                ).fetchall()
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO main.raw (id, data, date)
+                    SELECT b.id, b.data, b.date FROM bundle.raw b
+                    LEFT JOIN main.raw m ON m.id = b.id
+                    WHERE m.id IS NULL OR b.date > m.date
+                """
+                )
+                # parsed versions of the replaced payloads are out of date
+                conn.executemany(
+                    "DELETE FROM parsed WHERE id = ?",
+                    [(document_id,) for document_id, new in changed if not new],
+                )
+        finally:
+            conn.execute("DETACH DATABASE bundle")
+        added = sum(1 for _, new in changed if new)
+        return added, len(changed) - added
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Persistent worker for llm_script_mode = persistent.
+# Reads one JSON request per line on stdin and writes one JSON response per
+# line on stdout, copying the request "id" so PINT can match them up.
+import sys
+import json
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+OLLAMA_URL = "http://localhost:11434/api/generate"
+MODEL = "llama3-chatqa"
+
+write_lock = threading.Lock()
+
+
+def answer(request):
+    body = json.dumps(
+        {
+            "model": MODEL,
+            "system": request.get("system", ""),
+            "prompt": request["prompt"],
+            "stream": False,
+        }
+    ).encode()
+    try:
+        req = urllib.request.Request(
+            OLLAMA_URL, data=body, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(req) as response:
+            result = {"id": request["id"], "content": json.load(response)["response"]}
+    except Exception as e:
+        result = {"id": request["id"], "error": str(e)}
+
+    with write_lock:
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+with ThreadPoolExecutor(max_workers=4) as executor:
+    for line in sys.stdin:
+        if line.strip():
+            executor.submit(answer, json.loads(line))
@@ -1,16 +1,21 @@
 import json
+import asyncio
 import subprocess
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
-from .prompt_cache_sqlite import PromptCache  # Import the SQLite-based cache
-from .retry import retry
+from .prompt_cache_memory import make_prompt_cache
+from .retry import retry, aretry
+from .replay import CacheMiss
+from .rate_limit import get_rate_limiter
+from .utils import estimate_tokens, build_messages
+from .script_worker import PersistentScript, DEFAULT_SCRIPT_TIMEOUT
 
 
 class ExternalEngine:
     def __init__(self, model_data, cache_folder: str = "cache", max_tokens: int = 4096):
-        """Initialize the engine with caching using SQLite."""
+        """Initialize the engine with the prompt cache (memory tier + SQLite by default)."""
 
-        self.cache = PromptCache(cache_folder)  # Use the imported cache class
+        self.cache = make_prompt_cache(model_data, cache_folder)
         self.max_tokens = max_tokens  # note not used for external engine
         self.model_engine = model_data.get("model_name")
         if isinstance(self.model_engine, list):
@@ -20,44 +25,73 @@ class ExternalEngine:
             raise RuntimeError(
                 "To use an External LLM script, llm_script must be specified in the config file."
             )
+        # Shared with every engine calling the same script
+        self.rate_limiter = get_rate_limiter(
+            ("external", self.llm_script, self.model_engine),
+            model_data.get("requests_per_minute"),
+            model_data.get("tokens_per_minute"),
+        )
+        # Set to a Replay to answer only from the cache
+        self.replay = None
+        # "persistent" starts the script once and sends it one JSON request per line
+        self.worker = None
+        if str(model_data.get("llm_script_mode", "once")).lower() == "persistent":
+            self.worker = PersistentScript(
+                [self.llm_script],
+                timeout=float(model_data.get("script_timeout", DEFAULT_SCRIPT_TIMEOUT)),
+            )
 
-    def prompt(self, prompt: str, system: str = ""):
+    def prompt(self, prompt: str, system: str = "", prefix: str = ""):
         """Generates a response using the external script, with caching."""
-        messages = [
-            {"role": "system", "content": system},
-            {"role": "user", "content": prompt},
-        ]
+        messages = build_messages(prompt, system, prefix)
         response = self.create_chat_completion(messages)
         return response["choices"][0]["message"]["content"]
 
-    @retry
-    def create_chat_completion(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
-        """Handles chat completion with caching support."""
+    async def aprompt(self, prompt: str, system: str = "", prefix: str = ""):
+        """Async version of prompt, the script is run without blocking the event loop."""
+        messages = build_messages(prompt, system, prefix)
+        response = await self.acreate_chat_completion(messages)
+        return response["choices"][0]["message"]["content"]
+
+    @staticmethod
+    def _build_payload(
+        messages: List[Dict[str, str]],
+    ) -> Tuple[str, str, Dict[str, Any]]:
+        """Returns the system, prompt and the payload for the external script."""
         # Extract system and user messages
         system = " ".join(m["content"] for m in messages if m["role"] == "system")
         prompt = " ".join(m["content"] for m in messages if m["role"] == "user")
 
-        # Check cache first
-        cached_response = self.cache.get_cached_response(
-            self.model_engine, system, prompt
-        )
-        if cached_response:
-            return {"choices": [cached_response]}
-
-        # Prepare the prompt for the external script
         payload = {
             "messages": messages,
             "system": system,
             "prompt": prompt,
         }
+        return system, prompt, payload
 
-        local_prompt = json.dumps(payload)
+    @staticmethod
+    def _worker_content(response: Dict[str, Any]) -> str:
+        if "error" in response:
+            raise RuntimeError(f"External LLM worker failed: {response['error']}")
+        return response.get("content", "")
 
-        # Run the external script
+    @staticmethod
+    def _wrap(content: str) -> Dict[str, Any]:
+        return {
+            "message": {
+                "role": "assistant",
+                "content": content.strip(),
+            }
+        }
+
+    def _run_script(self, payload: Dict[str, Any]) -> str:
+        """Sends the payload to the worker, or runs the script once for it."""
+        if self.worker is not None:
+            return self._worker_content(self.worker.request(payload))
         try:
             result = subprocess.run(
                 [self.llm_script],
-                input=local_prompt,
+                input=json.dumps(payload),
                 capture_output=True,
                 text=True,
                 check=True,
@@ -66,16 +100,83 @@ class ExternalEngine:
             raise RuntimeError(
                 f"External LLM script failed: {e.stderr or e.stdout}"
             ) from e
+        return result.stdout
+
+    async def _arun_script(self, payload: Dict[str, Any]) -> str:
+        """Async version of _run_script, with asyncio.create_subprocess_exec."""
+        if self.worker is not None:
+            return self._worker_content(await self.worker.arequest(payload))
+        process = await asyncio.create_subprocess_exec(
+            self.llm_script,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate(json.dumps(payload).encode())
+        content = stdout.decode()
+        if process.returncode != 0:
+            raise RuntimeError(
+                f"External LLM script failed: {stderr.decode() or content}"
+            )
+        return content
+
+    @retry(give_up=(CacheMiss,))
+    def create_chat_completion(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """Handles chat completion with caching support."""
+        system, prompt, payload = self._build_payload(messages)
+
+        # Check cache first
+        cached_response = self.cache.get_cached_response(
+            self.model_engine, system, prompt
+        )
+        if self.replay is not None:
+            # offline replay never calls the model
+            cached_response = self.replay.check(
+                self.model_engine, prompt, cached_response
+            )
+        if cached_response:
+            return {"choices": [cached_response]}
+
+        tokens = estimate_tokens(system + prompt)
+        self.rate_limiter.acquire(tokens)
+        try:
+            content = self._run_script(payload)
+        finally:
+            self.rate_limiter.release(tokens)
 
         # Process the output
-        content = result.stdout.strip()
-        wrapped = {
-            "message": {
-                "role": "assistant",
-                "content": content,
-            }
-        }
+        wrapped = self._wrap(content)
 
         # Save the response to cache
         self.cache.save_response(self.model_engine, system, prompt, wrapped)
         return {"choices": [wrapped]}
+
+    @aretry(give_up=(CacheMiss,))
+    async def acreate_chat_completion(
+        self, messages: List[Dict[str, str]]
+    ) -> Dict[str, Any]:
+        """Async chat completion, the script is run without blocking the event loop."""
+        system, prompt, payload = self._build_payload(messages)
+
+        cached_response = await self.cache.aget_cached_response(
+            self.model_engine, system, prompt
+        )
+        if self.replay is not None:
+            # offline replay never calls the model
+            cached_response = self.replay.check(
+                self.model_engine, prompt, cached_response
+            )
+        if cached_response:
+            return {"choices": [cached_response]}
+
+        tokens = estimate_tokens(system + prompt)
+        await self.rate_limiter.aacquire(tokens)
+        try:
+            content = await self._arun_script(payload)
+        finally:
+            self.rate_limiter.release(tokens)
+
+        wrapped = self._wrap(content)
+
+        await self.cache.asave_response(self.model_engine, system, prompt, wrapped)
+        return {"choices": [wrapped]}
@@ -0,0 +1,160 @@
+import csv
+import gzip
+import json
+from typing import Any, Iterator, Optional, TextIO
+
+# Characters read at a time when parsing a JSON list
+JSON_CHUNK_SIZE = 64 * 1024
+
+
+class IdSource:
+    """
+    The IDs listed in a documents_data file, read lazily: iterating opens
+    the file and yields the IDs one at a time, so a long list starts
+    processing straight away with flat memory, and every iteration (e.g.
+    each batch pass) reads the file again.
+
+    Supported formats are CSV and Excel (.xlsx) files with a column_name
+    column, JSON lists of IDs or {column_name: id} objects, JSON Lines
+    (.jsonl) with one of those per line, and text files (.txt) with one ID
+    per line.  Any of them but Excel can be gzip-compressed (.gz).
+    Without a column_name the first column is used.
+    """
+
+    def __init__(self, path: str, column_name: Optional[str] = None):
+        self.path = path
+        self.column_name = column_name
+        name = path.lower()
+        self.compressed = name.endswith(".gz")
+        if self.compressed:
+            name = name[: -len(".gz")]
+        self.format = name.rsplit(".", 1)[-1] if "." in name else "txt"
+        if self.format == "ndjson":
+            self.format = "jsonl"
+        if self.format not in ("csv", "xlsx", "json", "jsonl", "txt"):
+            raise ValueError(
+                f"Unsupported documents_data file {path}, "
+                "use .csv, .xlsx, .json, .jsonl or .txt"
+            )
+        if self.format == "xlsx" and self.compressed:
+            raise ValueError("Excel files cannot be gzip-compressed")
+
+    def _open(self) -> TextIO:
+        if self.compressed:
+            return gzip.open(self.path, "rt", newline="", encoding="utf-8")
+        return open(self.path, "r", newline="", encoding="utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        if self.format == "xlsx":
+            yield from self._read_xlsx()
+            return
+        with self._open() as file:
+            if self.format == "csv":
+                yield from self._read_csv(file)
+            elif self.format == "json":
+                for element in iter_json_list(file):
+                    pubmed_id = self._from_element(element)
+                    if pubmed_id:
+                        yield pubmed_id
+            elif self.format == "jsonl":
+                for line in file:
+                    if line.strip():
+                        pubmed_id = self._from_element(json.loads(line))
+                        if pubmed_id:
+                            yield pubmed_id
+            else:
+                for line in file:
+                    line = line.strip()
+                    if line:
+                        yield line
+
+    def _read_csv(self, file: TextIO) -> Iterator[str]:
+        reader = csv.DictReader(file)
+        if not reader.fieldnames:
+            return
+        column_name = self.column_name or reader.fieldnames[0]
+        if column_name not in reader.fieldnames:
+            raise ValueError(f"Column '{column_name}' not found in the CSV file.")
+        for row in reader:
+            if row[column_name]:
+                yield row[column_name]
+
+    def _read_xlsx(self) -> Iterator[str]:
+        try:
+            import openpyxl
+        except ModuleNotFoundError as e:
+            raise ValueError("To load Excel files openpyxl must be installed") from e
+
+        # read_only streams the rows instead of loading the whole workbook
+        wb = openpyxl.load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            headers = list(next(rows, ()))
+            column_name = self.column_name or (headers[0] if headers else None)
+            if column_name not in headers:
+                raise ValueError(f"Column '{column_name}' not found in the Excel file.")
+            col_index = headers.index(column_name)
+            for row in rows:
+                if col_index < len(row) and row[col_index]:
+                    # Convert to string to ensure consistency
+                    yield str(row[col_index])
+        finally:
+            wb.close()
+
+    def _from_element(self, element: Any) -> Optional[str]:
+        if isinstance(element, str):
+            return element
+        if isinstance(element, dict):
+            value = element.get(self.column_name)
+            return None if value is None else str(value)
+        if isinstance(element, (int, float)) and not isinstance(element, bool):
+            return str(element)
+        raise ValueError(
+            "The file must be a JSON list of strings or {column_name:id} dicts"
+        )
+
+
+def iter_json_list(file: TextIO, chunk_size: int = JSON_CHUNK_SIZE) -> Iterator[Any]:
+    """Yields the elements of the JSON list in file, parsing it a chunk at a time."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    at_end = False
+
+    def next_token() -> str:
+        # skips whitespace and commas, reading more of the file as needed
+        nonlocal buffer, position, at_end
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) or at_end:
+                return buffer[position : position + 1]
+            buffer, position = file.read(chunk_size), 0
+            at_end = not buffer
+
+    if next_token() != "[":
+        raise ValueError(
+            "The file must be a JSON list of strings or {column_name:id} dicts"
+        )
+    position += 1
+
+    while True:
+        token = next_token()
+        if token == "]":
+            return
+        if not token:
+            raise ValueError("The JSON list is not terminated")
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+                # a number cut by the end of the buffer goes on in the next chunk
+                if at_end or (end < len(buffer) and buffer[end] in " \t\r\n,]"):
+                    break
+            except json.JSONDecodeError:
+                if at_end:
+                    raise
+            more = file.read(chunk_size)
+            at_end = not more
+            buffer, position = buffer[position:] + more, 0
+        yield element
+        position = end
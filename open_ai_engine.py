@@ -1,8 +1,10 @@
 import os
-from typing import Optional, List, Dict, Any
+import time
+import json
+from typing import Optional, List, Dict, Any, Tuple
 
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
     import openai
 
     RETRY_EXCEPTIONS = (
@@ -17,8 +19,11 @@ except ModuleNotFoundError:
     RETRY_EXCEPTIONS = ()
     OPENAI_AVAILABLE = False
 
-from .prompt_cache_sqlite import PromptCache
-from .retry import retry
+from .prompt_cache_memory import make_prompt_cache
+from .retry import retry, aretry
+from .batch import BatchPending
+from .rate_limit import get_rate_limiter
+from .utils import estimate_tokens, build_messages, UsageCounter
 
 
 class OpenAIEngine:
@@ -40,43 +45,216 @@ class OpenAIEngine:
         self.model_engine = model_data.get("model_name")
         self.max_tokens = max_tokens
         self.client = OpenAI(api_key=key, base_url=api_url)
+        self.async_client = AsyncOpenAI(api_key=key, base_url=api_url)
         self.cache_folder = cache_folder
-        self.cache = PromptCache(cache_folder)  # Use the imported cache class
+        self.cache = make_prompt_cache(model_data, cache_folder)
+        # Set to a BatchCollector to queue uncached prompts instead of sending them
+        self.batch_collector = None
+        # Set to a Replay to answer only from the cache
+        self.replay = None
+        self.batch_poll_interval = float(model_data.get("batch_poll_interval", 60))
+        # Shared with every engine calling the same model
+        self.rate_limiter = get_rate_limiter(
+            ("openai", api_url, self.model_engine),
+            model_data.get("requests_per_minute"),
+            model_data.get("tokens_per_minute"),
+        )
+        # Token usage reported by the API, including automatic prompt caching
+        self.usage = UsageCounter()
 
-    def prompt(self, prompt: str, system: str = "") -> str:
-        messages = [
-            {"role": "system", "content": system},
-            {"role": "user", "content": prompt},
-        ]
+    def prompt(self, prompt: str, system: str = "", prefix: str = "") -> str:
+        messages = build_messages(prompt, system, prefix)
         response = self.create_chat_completion(messages)
         return response["choices"][0]["message"]["content"]
 
-    # create_chat_completion is used internally for API compatibility
-    @retry(exceptions=RETRY_EXCEPTIONS)
-    def create_chat_completion(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    async def aprompt(self, prompt: str, system: str = "", prefix: str = "") -> str:
+        messages = build_messages(prompt, system, prefix)
+        response = await self.acreate_chat_completion(messages)
+        return response["choices"][0]["message"]["content"]
+
+    @staticmethod
+    def _split_messages(messages: List[Dict[str, str]]) -> Tuple[str, str]:
         system = "".join(m["content"] for m in messages if m["role"] == "system")
         prompt = "".join(m["content"] for m in messages if m["role"] == "user")
+        return system, prompt
 
-        cached = self.cache.get_cached_response(self.model_engine, system, prompt)
-        if cached:
-            return {"choices": [cached]}
+    @staticmethod
+    def _used_tokens(response) -> Optional[int]:
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return None
+        return usage.total_tokens
 
-        response = self.client.chat.completions.create(
-            model=self.model_engine,
-            messages=messages,
-            max_tokens=self.max_tokens,
-            temperature=0,
-            n=1,
+    def _record_usage(self, response) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        self.usage.add(
+            input=usage.prompt_tokens - cached,
+            output=usage.completion_tokens,
+            cache_read=cached,
         )
 
-        msg = response.choices[0].message
-        wrapped = {
+    @staticmethod
+    def _wrap(content: str) -> Dict[str, Any]:
+        return {
             "message": {
                 "role": "assistant",
-                "content": msg.content,
+                "content": content,
             }
         }
 
+    # create_chat_completion is used internally for API compatibility
+    @retry(exceptions=RETRY_EXCEPTIONS)
+    def create_chat_completion(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        system, prompt = self._split_messages(messages)
+
+        cached = self.cache.get_cached_response(self.model_engine, system, prompt)
+        if self.replay is not None:
+            # offline replay never calls the model
+            cached = self.replay.check(self.model_engine, prompt, cached)
+        if cached:
+            return {"choices": [cached]}
+
+        if self.batch_collector is not None:
+            self.batch_collector.add(system, prompt, messages)
+            raise BatchPending(f"{self.model_engine} prompt queued for batch")
+
+        tokens = estimate_tokens(system + prompt)
+        self.rate_limiter.acquire(tokens)
+        try:
+            raw = self.client.chat.completions.with_raw_response.create(
+                model=self.model_engine,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=0,
+                n=1,
+            )
+        except openai.RateLimitError as e:
+            self.rate_limiter.update_from_headers(e.response.headers, tokens)
+            raise
+        except Exception:
+            self.rate_limiter.release(tokens)
+            raise
+        self.rate_limiter.update_from_headers(raw.headers, tokens)
+        response = raw.parse()
+        self.rate_limiter.settle(tokens, self._used_tokens(response))
+        self._record_usage(response)
+
+        wrapped = self._wrap(response.choices[0].message.content)
+
         # Save response to cache
         self.cache.save_response(self.model_engine, system, prompt, wrapped)
         return {"choices": [wrapped]}
+
+    @aretry(exceptions=RETRY_EXCEPTIONS)
+    async def acreate_chat_completion(
+        self, messages: List[Dict[str, str]]
+    ) -> Dict[str, Any]:
+        system, prompt = self._split_messages(messages)
+
+        cached = await self.cache.aget_cached_response(
+            self.model_engine, system, prompt
+        )
+        if self.replay is not None:
+            # offline replay never calls the model
+            cached = self.replay.check(self.model_engine, prompt, cached)
+        if cached:
+            return {"choices": [cached]}
+
+        if self.batch_collector is not None:
+            self.batch_collector.add(system, prompt, messages)
+            raise BatchPending(f"{self.model_engine} prompt queued for batch")
+
+        tokens = estimate_tokens(system + prompt)
+        await self.rate_limiter.aacquire(tokens)
+        try:
+            raw = await self.async_client.chat.completions.with_raw_response.create(
+                model=self.model_engine,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=0,
+                n=1,
+            )
+        except openai.RateLimitError as e:
+            self.rate_limiter.update_from_headers(e.response.headers, tokens)
+            raise
+        except Exception:
+            self.rate_limiter.release(tokens)
+            raise
+        self.rate_limiter.update_from_headers(raw.headers, tokens)
+        response = raw.parse()
+        self.rate_limiter.settle(tokens, self._used_tokens(response))
+        self._record_usage(response)
+
+        wrapped = self._wrap(response.choices[0].message.content)
+
+        await self.cache.asave_response(self.model_engine, system, prompt, wrapped)
+        return {"choices": [wrapped]}
+
+    def run_batch(self, requests: List[Dict[str, Any]]) -> int:
+        """
+        Sends the requests through the Batch API, waits for the batch to
+        finish and saves the replies to the cache.  Returns the number of
+        replies saved.
+        """
+        lines = []
+        for i, request in enumerate(requests):
+            lines.append(
+                json.dumps(
+                    {
+                        "custom_id": f"request-{i}",
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": self.model_engine,
+                            "messages": request["messages"],
+                            "max_tokens": self.max_tokens,
+                            "temperature": 0,
+                            "n": 1,
+                        },
+                    }
+                )
+            )
+
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Submitted batch {batch.id} with {len(lines)} requests")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.batch_poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+
+        if not batch.output_file_id:
+            print(f"Batch {batch.id} {batch.status} without output")
+            return 0
+
+        saved = 0
+        output = self.client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                print(f"Batch request {item.get('custom_id')} failed")
+                continue
+
+            request = requests[int(item["custom_id"].split("-")[1])]
+            content = response["body"]["choices"][0]["message"]["content"]
+            self.cache.save_response(
+                self.model_engine,
+                request["system"],
+                request["prompt"],
+                self._wrap(content),
+            )
+            saved += 1
+
+        return saved
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import fnmatch
+import threading
+from collections.abc import Mapping
+from typing import Optional, Dict, Any, Iterable, Iterator, Tuple
+
+# How often the log is fsynced, in seconds, 0 syncs after every document
+DEFAULT_SYNC_INTERVAL = 5.0
+
+# Suffix of a new log while its run is going, see OutputLog
+PARTIAL_SUFFIX = ".partial"
+
+# Status of a document in the log
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class OutputLog:
+    """
+    Append-only JSONL log of the finished documents, one line per document
+    with its ID, status, output row and debug data.  Lines are flushed as
+    documents finish and fsynced every sync_interval seconds, so the log is
+    never rewritten and a crash loses at most the last few seconds.  The CSV
+    and JSON outputs are materialized from it at the end of the run, or on
+    demand with read(), and a resumed run skips the documents it lists.
+
+    A new log is written to path + ".partial" and replaces the log at path
+    when the run finishes, so a run that is interrupted or fails leaves the
+    earlier log as it was.  Appending goes on with the partial log of an
+    interrupted run if there is one, otherwise with the log itself.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sync_interval: float = DEFAULT_SYNC_INTERVAL,
+        append: bool = False,
+    ):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.partial_path = path + PARTIAL_SUFFIX
+        if append and not os.path.exists(self.partial_path):
+            self.partial_path = None
+        self._file = open(
+            self.partial_path or path, "a" if append else "w", encoding="utf-8"
+        )
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+    def append(
+        self,
+        document_id: str,
+        status: str,
+        output: Optional[Dict[str, Any]] = None,
+        debug: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        line = json.dumps(
+            {"id": document_id, "status": status, "output": output, "debug": debug},
+            ensure_ascii=False,
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            if time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self) -> None:
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def close(self, finished: bool = True) -> None:
+        """Closes the log, replacing the earlier log with it if finished."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                self._sync()
+                self._file.close()
+                if finished and self.partial_path is not None:
+                    os.replace(self.partial_path, self.path)
+
+    def __enter__(self) -> "OutputLog":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        self.close(finished=exc_type is None)
+
+    @staticmethod
+    def latest(path: str) -> str:
+        """The log of the latest run: the partial log of an unfinished run, if any."""
+        partial_path = path + PARTIAL_SUFFIX
+        return partial_path if os.path.exists(partial_path) else path
+
+    @staticmethod
+    def read(path: str) -> Tuple["LogRows", "LogRows", Dict[str, str]]:
+        """
+        Returns the output rows, debug rows and statuses of a log, by
+        document ID in the order they were first written.  A later line for
+        the same ID replaces the earlier one.  Only the position of each
+        row is kept in memory, the rows are read from the file when used.
+        """
+        outputs = {}
+        debugs = {}
+        status = {}
+        offset = 0
+        with open(path, "rb") as log_file:
+            for line in log_file:
+                start = offset
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line can be cut short by a crash
+                    continue
+                document_id = record["id"]
+                status[document_id] = record.get("status", DONE)
+                for rows, field in ((outputs, "output"), (debugs, "debug")):
+                    if record.get(field) is None:
+                        rows.pop(document_id, None)
+                    else:
+                        rows[document_id] = start
+        return (
+            LogRows(path, outputs, "output"),
+            LogRows(path, debugs, "debug"),
+            status,
+        )
+
+
+class LogRows(Mapping):
+    """
+    Read-only mapping of document ID to its output or debug row in a log,
+    given the offsets of the lines holding the rows.
+    """
+
+    def __init__(self, path: str, offsets: Dict[str, int], field: str):
+        self.path = path
+        self.offsets = offsets
+        self.field = field
+
+    def _read(self) -> Iterator[Tuple[str, Any]]:
+        # one pass over the file, in the order of the rows
+        with open(self.path, "rb") as log_file:
+            for document_id, offset in self.offsets.items():
+                log_file.seek(offset)
+                yield document_id, json.loads(log_file.readline())[self.field]
+
+    def __getitem__(self, document_id: str) -> Dict[str, Any]:
+        with open(self.path, "rb") as log_file:
+            log_file.seek(self.offsets[document_id])
+            return json.loads(log_file.readline())[self.field]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return self._read()
+
+    def values(self) -> Iterator[Any]:
+        return (row for _, row in self._read())
+
+
+class DebugCapture:
+    """
+    Picks what the debug output keeps of a document's data store: the
+    entries whose names match one of keys and none of exclude (shell-style
+    patterns, e.g. "reply_*"), with text longer than max_length characters
+    cut short.  max_length 0 keeps the values whole.
+    """
+
+    def __init__(
+        self,
+        keys: Iterable[str] = ("*",),
+        exclude: Iterable[str] = (),
+        max_length: int = 0,
+    ):
+        self.keys = list(keys)
+        self.exclude = list(exclude)
+        self.max_length = max_length
+        self._kept = {}
+
+    @classmethod
+    def from_config(cls, model_data) -> "DebugCapture":
+        def patterns(value):
+            if isinstance(value, str):
+                return value.replace(",", " ").split()
+            return list(value)
+
+        return cls(
+            patterns(model_data.get("debug_keys", ["*"])),
+            patterns(model_data.get("debug_exclude", [])),
+            int(model_data.get("debug_max_length", 0)),
+        )
+
+    def keep(self, name: str) -> bool:
+        kept = self._kept.get(name)
+        if kept is None:
+            kept = any(fnmatch.fnmatchcase(name, p) for p in self.keys) and not any(
+                fnmatch.fnmatchcase(name, p) for p in self.exclude
+            )
+            self._kept[name] = kept
+        return kept
+
+    def __call__(self, data_store: Dict[str, Any]) -> Dict[str, Any]:
+        captured = {}
+        for name, value in data_store.items():
+            if not self.keep(name):
+                continue
+            if self.max_length and isinstance(value, str):
+                value = value[: self.max_length]
+            captured[name] = value
+        return captured
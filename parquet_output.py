@@ -0,0 +1,111 @@
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .output_log import PARTIAL_SUFFIX
+
+DEFAULT_ROW_GROUP = 1000
+
+
+class ParquetOutput:
+    """
+    Writes the output rows to a Parquet file as documents finish, one row
+    group per row_group rows, so the rows are not all held in memory.
+    Every column is a string column holding the values exactly as they were
+    extracted.  Columns are dictionary encoded, which stores repetitive
+    answers such as yes/no once per row group; dictionary can name the
+    columns to encode, the rest are stored plain.
+
+    Like the output log, the file is written to path + ".partial" and
+    replaces the file at path when the run finishes, so a run that fails
+    leaves the earlier output as it was.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        id_column: str,
+        columns: List[str],
+        row_group: int = DEFAULT_ROW_GROUP,
+        dictionary: Optional[List[str]] = None,
+        compression: str = "snappy",
+    ):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ModuleNotFoundError as e:
+            raise ValueError("To write Parquet output pyarrow must be installed") from e
+
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        self.columns = [id_column] + [c for c in columns if c != id_column]
+        self.row_group = max(1, row_group)
+        self._pa = pyarrow
+        self.schema = pyarrow.schema(
+            [pyarrow.field(column, pyarrow.string()) for column in self.columns]
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(
+            self.partial_path,
+            self.schema,
+            use_dictionary=dictionary if dictionary is not None else True,
+            compression=compression,
+        )
+        self._id_column = id_column
+        self._rows: List[Tuple[str, Dict[str, Any]]] = []
+        self.written = 0
+
+    @classmethod
+    def from_config(
+        cls, model_data, path: str, id_column: str, columns: List[str]
+    ) -> "ParquetOutput":
+        dictionary = model_data.get("parquet_dictionary")
+        if isinstance(dictionary, str):
+            dictionary = dictionary.replace(",", " ").split()
+        return cls(
+            path,
+            id_column,
+            columns,
+            int(model_data.get("parquet_row_group", DEFAULT_ROW_GROUP)),
+            dictionary,
+            model_data.get("parquet_compression", "snappy"),
+        )
+
+    def append(self, document_id: str, row: Dict[str, Any]) -> None:
+        self._rows.append((document_id, row))
+        if len(self._rows) >= self.row_group:
+            self.flush()
+
+    def extend(self, rows: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+        for document_id, row in rows:
+            self.append(document_id, row)
+
+    @staticmethod
+    def _text(value: Any) -> Optional[str]:
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+    def flush(self) -> None:
+        """Writes the buffered rows as one row group."""
+        if not self._rows:
+            return
+        data = {self._id_column: [document_id for document_id, _ in self._rows]}
+        for column in self.columns[1:]:
+            data[column] = [self._text(row.get(column)) for _, row in self._rows]
+        table = self._pa.Table.from_pydict(data, schema=self.schema)
+        self._writer.write_table(table, row_group_size=len(self._rows))
+        self.written += len(self._rows)
+        self._rows = []
+
+    def close(self, finished: bool = True) -> None:
+        """Closes the file, replacing the earlier output with it if finished."""
+        if self._writer.is_open:
+            self.flush()
+            self._writer.close()
+            if finished:
+                os.replace(self.partial_path, self.path)
+
+    def __enter__(self) -> "ParquetOutput":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        self.close(finished=exc_type is None)
@@ -1,17 +1,25 @@
-import csv
 import os
 import json
 import subprocess
 import re
 import shlex
-from typing import List, Dict, Any, Union, Tuple
+from collections import deque
+from itertools import islice
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Any, Iterable, Iterator, Union, Tuple, Optional
 
-from .utils import log_traceback
-from .process_papers import process_pubmed_id, save_output
+from .utils import log_traceback, parse_size, isYes
+from .process_papers import process_pubmed_id, fetch_pubmed_data, save_output
 
 from .workflow_context import WorkflowContext
 from .model_data import ModelDataLoader
 from .prompt_data import PromptDataParser
+from .batch import BatchCollector
+from .replay import CacheMiss
+from .output_log import OutputLog, DEFAULT_SYNC_INTERVAL, FAILED, SKIPPED
+from .parquet_output import ParquetOutput
+from .id_source import IdSource
 
 model_data = ModelDataLoader()
 parser = PromptDataParser()
@@ -25,146 +33,350 @@ def setup(ctx=context) -> None:
     ctx.setup_llm_engine(model_data)
 
 
-def read_pubmed_ids(file_path: str, column_name: str) -> List[str]:
+def read_pubmed_ids(file_path: str, column_name: str) -> IdSource:
     """
-    Reads PubMed IDs from a specified column in either a CSV, XLSX, or JSON file.
-    Returns a list of PubMed IDs.
+    Returns the IDs in a specified column of a CSV, XLSX, JSON or JSON Lines
+    file, or a text file with one ID per line, optionally gzip-compressed.
+    The IDs are read lazily each time the result is iterated.
     """
-    pubmed_ids = []
+    return IdSource(model_data.resolve_path(file_path), column_name)
 
-    file_path = model_data.resolve_path(file_path)
 
-    if file_path.endswith(".csv"):
-        with open(file_path, "r", newline="", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            if column_name not in reader.fieldnames:
-                raise ValueError(f"Column '{column_name}' not found in the CSV file.")
+def get_output_files(ctx=context, shard: Optional[int] = None) -> Tuple[str, ...]:
+    """
+    Returns the csv, json, debug csv and debug json output paths.
+    When running a shard, the file names get a _shard<i>of<N> suffix.
+    """
+    output_folder = model_data.get("output_folder", "output")
+    output_file = model_data.get("output_file", "output.csv")
 
-            pubmed_ids = [row[column_name] for row in reader if row[column_name]]
+    output_file_base = output_file.split(".")[0]
+    output_file_ext = output_file.split(".")[-1]
 
-    elif file_path.endswith(".xlsx"):
+    if shard is None and ctx.shard_count > 1:
+        shard = ctx.shard_index
+    if shard is not None:
+        output_file_base += f"_shard{shard}of{ctx.shard_count}"
+        output_file = output_file_base + "." + output_file_ext
 
-        try:
-            import openpyxl
-        except ModuleNotFoundError as e:
-            raise ValueError("To load Excel files openpyxl must be installed") from e
+    os.makedirs(output_folder, exist_ok=True)
 
-        wb = openpyxl.load_workbook(file_path, data_only=True)
-        sheet = wb.active
+    return (
+        os.path.join(output_folder, output_file),
+        os.path.join(output_folder, output_file_base + ".json"),
+        os.path.join(output_folder, output_file_base + "_debug." + output_file_ext),
+        os.path.join(output_folder, output_file_base + "_debug.json"),
+    )
 
-        # Find the column index by matching the header
-        headers = [cell.value for cell in sheet[1]]
-        if column_name not in headers:
-            raise ValueError(f"Column '{column_name}' not found in the Excel file.")
 
-        col_index = (
-            headers.index(column_name) + 1
-        )  # Convert to 1-based index for openpyxl
+def get_output_log(ctx=context, shard: Optional[int] = None) -> str:
+    """Returns the path of the JSONL log of finished documents, next to the csv output."""
+    return os.path.splitext(get_output_files(ctx, shard)[0])[0] + ".jsonl"
 
-        # Extract PubMed IDs from the column
-        for row in sheet.iter_rows(
-            min_row=2, max_row=sheet.max_row, min_col=col_index, max_col=col_index
-        ):
-            if row[0].value:
-                pubmed_ids.append(
-                    str(row[0].value)
-                )  # Convert to string to ensure consistency
-
-    elif file_path.endswith(".json"):
-        with open(file_path, mode="r", encoding="utf-8") as jsonfile:
-            data = json.load(jsonfile)
-
-            if not isinstance(data, list):
-                raise ValueError(
-                    "File list be a JSON list of strings or {column_name:id} dicts"
-                )
 
-            for elem in data:
-                if isinstance(elem, str):
-                    pubmed_ids.append(elem)
-                elif isinstance(elem, dict):
-                    pubmed_ids.append(elem.get(column_name))
+def open_parquet_output(
+    ctx=context, shard: Optional[int] = None
+) -> Optional[ParquetOutput]:
+    """The Parquet output next to the csv output, if parquet_output is set."""
+    if not isYes(model_data.get("parquet_output", "false")):
+        return None
+    path = os.path.splitext(get_output_files(ctx, shard)[0])[0] + ".parquet"
+    return ParquetOutput.from_config(
+        model_data, path, ctx.column_name, output_columns()
+    )
 
-    return pubmed_ids
 
+def ids_to_process(pubmed_ids: Iterable[str], ctx=context) -> Iterator[str]:
+    """The IDs after start_from that belong to this run's shard and are not finished."""
+    return (
+        pubmed_id
+        for pubmed_id in islice(pubmed_ids, ctx.start_from, None)
+        if ctx.in_shard(pubmed_id) and pubmed_id not in ctx.finished
+    )
 
-def process_pubmed_ids(
-    pubmed_ids: List[str],
+
+def resume_from_log(ctx=context) -> None:
+    """
+    Marks the documents in the output log of an earlier run as finished,
+    except the failed ones with retry_failed.  Their rows stay in the log
+    and are written to the outputs with the new ones at the end.
+    """
+    log_file = OutputLog.latest(get_output_log(ctx))
+    if not os.path.exists(log_file):
+        print(f"No output log {log_file} to resume from, starting from the beginning.")
+        return
+
+    final_output, _, statuses = OutputLog.read(log_file)
+    ctx.output_count = len(final_output)
+    add_output_columns(ctx)
+    failed = [pubmed_id for pubmed_id, status in statuses.items() if status == FAILED]
+    ctx.finished = set(statuses)
+    if ctx.retry_failed:
+        ctx.finished.difference_update(failed)
+    print(
+        f"Resuming from {log_file}: {len(statuses)} IDs already processed, "
+        f"{len(failed)} of them failed"
+        + (", running those again." if ctx.retry_failed else ".")
+    )
+
+
+def prefetch_documents(
+    pubmed_ids: Iterable[str],
     sections_to_extract: Union[List[str], Dict[str, Any], None],
     data_folder: str,
     ctx=context,
-) -> List[Dict[str, Any]]:
-    processed_documents = []  # Store processed documents
+):
+    """
+    Yields (pubmed_id, future) pairs, with up to ctx.prefetch documents
+    fetched and parsed ahead in background threads.  The depth of the queue
+    bounds how many prefetched documents are held in memory.
+    Without prefetch the future is None and documents are fetched in turn.
+    """
+    if ctx.prefetch < 1:
+        for pubmed_id in pubmed_ids:
+            yield pubmed_id, None
+        return
 
-    output_folder = model_data.get("output_folder", "output")
-    output_file = model_data.get("output_file", "output.csv")
+    queue = deque()
+    with ThreadPoolExecutor(max_workers=ctx.prefetch) as executor:
+        try:
+            for pubmed_id in pubmed_ids:
+                queue.append(
+                    (
+                        pubmed_id,
+                        executor.submit(
+                            fetch_pubmed_data,
+                            pubmed_id,
+                            sections_to_extract,
+                            data_folder,
+                            ctx,
+                            model_data,
+                        ),
+                    )
+                )
+                if len(queue) > ctx.prefetch:
+                    yield queue.popleft()
+            while queue:
+                yield queue.popleft()
+        finally:
+            # stopped early, e.g. max_documents reached
+            for _, future in queue:
+                future.cancel()
+
+
+def process_single_id(
+    pubmed_id: str,
+    sections_to_extract: Union[List[str], Dict[str, Any], None],
+    data_folder: str,
+    ctx=context,
+    document_future: Optional[Future] = None,
+) -> Tuple[WorkflowContext, List[str]]:
+    """
+    Runs the workflow for one ID in its own document context.
+    Returns the document context and the list of processed documents,
+    ready to be merged into ctx.
+    document_future is the prefetch of the document, if there is one.
+    """
+    doc_ctx = ctx.document_context()
+    documents = []
+    try:
+        document_data = None
+        if document_future is not None:
+            document_data = document_future.result()
+        process_pubmed_id(
+            pubmed_id,
+            documents,
+            sections_to_extract,
+            data_folder,
+            doc_ctx,
+            model_data,
+            parser,
+            document_data,
+        )
+    except CacheMiss:
+        raise
+    except FileNotFoundError as e:
+        print(f"Skipping {pubmed_id}: {e}.")
+        doc_ctx.status = SKIPPED
+    except Exception as e:
+        print(f"Error with {pubmed_id}: {e}")
+        log_traceback(model_data.get("error_file", "error.log"))
+        doc_ctx.status = FAILED
+
+    if doc_ctx.status is None:
+        # no text to process
+        doc_ctx.status = SKIPPED
+    return doc_ctx, documents
 
-    output_file_base = output_file.split(".")[0]
-    output_file_ext = output_file.split(".")[-1]
 
-    output_file = os.path.join(output_folder, output_file)
-    output_file_json = os.path.join(output_folder, output_file_base + ".json")
+def process_pubmed_ids(
+    pubmed_ids: Iterable[str],
+    sections_to_extract: Union[List[str], Dict[str, Any], None],
+    data_folder: str,
+    ctx=context,
+) -> List[str]:
+    """
+    Runs the workflow for the IDs, appending each document to the output
+    log, and writes the outputs from the log.  Returns the processed IDs.
+    """
+    processed_documents = []
 
-    debug_output_file = os.path.join(
-        output_folder, output_file_base + "_debug." + output_file_ext
-    )
-    debug_output_file_json = os.path.join(
-        output_folder, output_file_base + "_debug.json"
+    output_file, output_file_json, debug_output_file, debug_output_file_json = (
+        get_output_files(ctx)
     )
+    # finished documents are appended to the log, the outputs are written at the end
+    log_file = get_output_log(ctx)
+
+    with ExitStack() as stack:
+        # opened before the log, so a missing pyarrow fails before any output
+        parquet = open_parquet_output(ctx)
+        if parquet is not None:
+            stack.enter_context(parquet)
+        output_log = stack.enter_context(
+            OutputLog(
+                log_file,
+                float(model_data.get("output_sync_interval", DEFAULT_SYNC_INTERVAL)),
+                append=ctx.resume,
+            )
+        )
+        if parquet is not None and ctx.resume:
+            # the rows of the documents finished before go first
+            parquet.extend(
+                OutputLog.read(output_log.partial_path or log_file)[0].items()
+            )
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=ctx.workers))
 
-    os.makedirs(output_folder, exist_ok=True)
+        # Keep a bounded window of documents in flight and merge them in
+        # submission order, so output order does not depend on timing
+        in_flight = deque()
+        remaining = prefetch_documents(
+            ids_to_process(pubmed_ids, ctx), sections_to_extract, data_folder, ctx
+        )
+        done = False
+
+        while not done:
+            for pubmed_id, document_future in remaining:
+                in_flight.append(
+                    (
+                        pubmed_id,
+                        executor.submit(
+                            process_single_id,
+                            pubmed_id,
+                            sections_to_extract,
+                            data_folder,
+                            ctx,
+                            document_future,
+                        ),
+                    )
+                )
+                if len(in_flight) >= 2 * ctx.workers:
+                    break
 
-    for pubmed_id in pubmed_ids[ctx.start_from :]:
-        try:
-            process_pubmed_id(
-                pubmed_id,
-                processed_documents,
-                sections_to_extract,
-                data_folder,
-                ctx,
-                model_data,
-                parser,
-            )
-        except FileNotFoundError as e:
-            print(f"Skipping {pubmed_id}: {e}.")
-            continue
-        except Exception as e:
-            print(f"Error with {pubmed_id}: {e}")
-            log_traceback(model_data.get("error_file", "error.log"))
-
-        if ctx.max_docs is not None:
-            if len(ctx.final_output) >= ctx.max_docs:
+            if not in_flight:
                 break
-        if len(ctx.final_output) > 0:
-            save_output(
-                ctx.final_output, output_file, output_file_json, ctx, model_data
-            )
-            save_output(
-                ctx.debug, debug_output_file, debug_output_file_json, ctx, model_data
-            )
-        else:
-            print("no output", pubmed_id)
 
-    print("Final Output")
-    print(ctx.final_output)
+            pubmed_id, future = in_flight.popleft()
+            doc_ctx, documents = future.result()
+            ctx.merge_document(doc_ctx)
+            processed_documents.extend(documents)
+            output = doc_ctx.final_output.get(pubmed_id)
+            output_log.append(
+                pubmed_id, doc_ctx.status, output, doc_ctx.debug.get(pubmed_id)
+            )
+            if parquet is not None and output is not None:
+                parquet.append(pubmed_id, output)
+
+            if ctx.max_docs is not None:
+                if ctx.output_count >= ctx.max_docs:
+                    for _, pending in in_flight:
+                        pending.cancel()
+                    done = True
+            if output is None:
+                print("no output", pubmed_id)
+
+    print(f"Final Output: {ctx.output_count} documents")
     print(ctx.ordered_column_list)
+    if parquet is not None:
+        print(f"Wrote {parquet.written} rows to {parquet.path}")
 
-    # Save outputs
-    if ctx.final_output:
-        save_output(ctx.final_output, output_file, output_file_json, ctx, model_data)
+    # Save outputs, reading the rows back from the log
+    final_output, debug, _ = OutputLog.read(log_file)
+    if final_output:
+        save_output(final_output, output_file, output_file_json, ctx, model_data)
     else:
         print(f"No final output to save to {output_file}")
 
-    if ctx.debug:
-        save_output(
-            ctx.debug, debug_output_file, debug_output_file_json, ctx, model_data
-        )
+    if debug:
+        save_output(debug, debug_output_file, debug_output_file_json, ctx, model_data)
     else:
         print(f"No debug output to save to {debug_output_file}")
 
     return processed_documents
 
 
+def run_batch_stages(
+    pubmed_ids: Iterable[str],
+    sections_to_extract: Union[List[str], Dict[str, Any], None],
+    data_folder: str,
+    ctx=context,
+) -> None:
+    """
+    Batch mode: runs the workflow breadth first to fill the prompt cache.
+    Each pass takes every document as far as the cache allows, queueing the
+    prompts that miss it.  These are sent as one provider batch and saved to
+    the cache before the next pass.  Stops when a pass queues nothing, after
+    which the normal run is answered from the cache.
+    """
+    engine = ctx.llm_engine
+    if not hasattr(engine, "run_batch"):
+        print(f"batch_mode is not supported for {ctx.which_api}, running interactively")
+        return
+
+    stage = 0
+    while True:
+        collector = BatchCollector()
+        engine.batch_collector = collector
+        try:
+            with ThreadPoolExecutor(max_workers=ctx.workers) as executor:
+                # results are dropped, the pass only fills the batch.  A
+                # bounded window of IDs is submitted so the list is read lazily
+                in_flight = deque()
+                failed = 0
+                for pubmed_id in ids_to_process(pubmed_ids, ctx):
+                    in_flight.append(
+                        executor.submit(
+                            process_single_id,
+                            pubmed_id,
+                            sections_to_extract,
+                            data_folder,
+                            ctx,
+                        )
+                    )
+                    if len(in_flight) >= 2 * ctx.workers:
+                        failed += in_flight.popleft().result()[0].status == FAILED
+                for future in in_flight:
+                    failed += future.result()[0].status == FAILED
+        finally:
+            engine.batch_collector = None
+
+        if failed:
+            # their remaining prompts are not queued, the run after the
+            # batch stages sends them directly if they get that far
+            print(
+                f"{failed} documents failed during batch stage {stage + 1}, "
+                f"see {model_data.get('error_file', 'error.log')}"
+            )
+
+        if not collector.requests:
+            break
+
+        stage += 1
+        print(f"Batch stage {stage}: {len(collector.requests)} prompts")
+        if engine.run_batch(collector.requests) == 0:
+            print("Batch returned no results, sending the remaining prompts directly")
+            break
+
+
 def search_for_pubmed_ids(
     search_script: str, search_term: str, search_options: str
 ) -> Tuple[List[str], str]:
@@ -197,12 +409,8 @@ def search_for_pubmed_ids(
     return pubmed_ids[1:], pubmed_ids[0]
 
 
-def parse_papers(config_file: Union[str, os.PathLike[str]], ctx=context) -> None:
-    model_data.load_model_data(config_file)
-
-    setup()
-
-    parser.load_prompt_data(model_data)
+def get_pubmed_ids(ctx=context) -> Iterable[str]:
+    """Returns the IDs to process, from the pubmed search or the documents_data file."""
     if ctx.use_pubmed_search:
         search_script = model_data.get("pubmed_search_script")
         search_term = model_data.get("pubmed_search_term")
@@ -216,13 +424,190 @@ def parse_papers(config_file: Union[str, os.PathLike[str]], ctx=context) -> None
         ctx.column_name = model_data.get("column_name")
         pubmed_ids = read_pubmed_ids(file_path, ctx.column_name)
 
+    return pubmed_ids
+
+
+def parse_papers(
+    config_file: Union[str, os.PathLike[str]],
+    ctx=context,
+    shard: Optional[str] = None,
+    replay: Optional[str] = None,
+    resume: bool = False,
+    retry_failed: bool = False,
+) -> None:
+    model_data.load_model_data(config_file)
+    if shard is not None:
+        model_data.data["shard"] = shard
+    if replay is not None:
+        model_data.data["replay"] = replay
+    if resume or retry_failed:
+        model_data.data["resume"] = "true"
+    if retry_failed:
+        model_data.data["retry_failed"] = "true"
+
+    setup()
+
+    parser.load_prompt_data(model_data)
+    pubmed_ids = get_pubmed_ids(ctx)
+
     # Get the list of processed documents
     sections_to_extract = model_data.get("sections")
-    num_pubmed_ids = len(pubmed_ids)
 
-    print(f"Processing {num_pubmed_ids} documents.")
+    if isinstance(pubmed_ids, IdSource):
+        # not counted, that would read the whole file before starting
+        print(f"Processing the documents listed in {pubmed_ids.path}.")
+    else:
+        print(f"Processing {len(pubmed_ids)} documents.")
+        if ctx.document_store is not None:
+            stored = ctx.document_store.existing_ids(pubmed_ids)
+            print(f"{len(stored)} of them are already in the document store.")
+    if ctx.shard_count > 1:
+        print(f"Running shard {ctx.shard_index} of {ctx.shard_count}.")
 
-    processed_documents = process_pubmed_ids(
-        pubmed_ids, sections_to_extract, ctx.data_cache_folder
-    )
+    if ctx.replay is not None:
+        print(f"Replaying from the cache, {ctx.replay.mode} on a cache miss.")
+
+    if ctx.resume:
+        resume_from_log(ctx)
+
+    try:
+        if ctx.batch_mode and ctx.replay is None:
+            run_batch_stages(pubmed_ids, sections_to_extract, ctx.data_cache_folder)
+
+        processed_documents = process_pubmed_ids(
+            pubmed_ids, sections_to_extract, ctx.data_cache_folder
+        )
+    except CacheMiss as e:
+        print(f"Replay stopped: {e}")
+        print(f"Replay: {ctx.replay.summary()}.")
+        raise
     print(f"Processed {len(processed_documents)} documents.")
+
+    cache = getattr(ctx.llm_engine, "cache", None)
+    if hasattr(cache, "stats"):
+        stats = cache.stats()
+        print(
+            f"Memory cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['entries']} entries."
+        )
+
+    if ctx.replay is not None:
+        print(f"Replay: {ctx.replay.summary()}.")
+
+    usage = getattr(ctx.llm_engine, "usage", None)
+    if usage is not None and usage.counts["requests"]:
+        print(f"Token usage: {usage.summary()}.")
+
+    # Keep the cache under cache_max_size by removing the least recently used replies
+    max_size = model_data.get("cache_max_size")
+    if max_size and hasattr(cache, "enforce_size_limit"):
+        removed = cache.enforce_size_limit(parse_size(max_size))
+        if removed:
+            print(f"Removed {removed} least recently used cached replies.")
+
+
+def merge_shards(
+    config_file: Union[str, os.PathLike[str]], shard_count: int, ctx=context
+) -> None:
+    """
+    Combines the outputs written by the shards of a run into the final output
+    files, and the Parquet output if parquet_output is set.  Rows follow the
+    order of the ID list, columns the order of the prompt rows, so the result
+    does not depend on how the work was split.
+    """
+    prepare_output(config_file, ctx)
+    ctx.shard_count = shard_count
+
+    for shard in range(shard_count):
+        _, shard_json, _, shard_debug_json = get_output_files(ctx, shard)
+        for shard_file, merged in (
+            (shard_json, ctx.final_output),
+            (shard_debug_json, ctx.debug),
+        ):
+            if not os.path.exists(shard_file):
+                print(f"No output for shard {shard}: {shard_file} not found")
+                continue
+            with open(shard_file, "r", encoding="utf-8") as f:
+                merged.update(json.load(f))
+
+    if not ctx.use_pubmed_search:
+        # put the rows back in input order
+        position = {pubmed_id: i for i, pubmed_id in enumerate(get_pubmed_ids(ctx))}
+        for merged in (ctx.final_output, ctx.debug):
+            rows = sorted(
+                merged.items(), key=lambda item: position.get(item[0], len(position))
+            )
+            merged.clear()
+            merged.update(rows)
+
+    ctx.shard_index, ctx.shard_count = 0, 1
+    output_file, output_file_json, debug_output_file, debug_output_file_json = (
+        get_output_files(ctx)
+    )
+    save_output(ctx.final_output, output_file, output_file_json, ctx, model_data)
+    save_output(ctx.debug, debug_output_file, debug_output_file_json, ctx, model_data)
+    parquet = open_parquet_output(ctx)
+    if parquet is not None:
+        # written from the merged rows, so it follows the same order
+        with parquet:
+            parquet.extend(ctx.final_output.items())
+        print(f"Wrote {parquet.written} rows to {parquet.path}")
+    print(f"Merged {len(ctx.final_output)} documents from {shard_count} shards.")
+
+
+def prepare_output(
+    config_file: Union[str, os.PathLike[str]],
+    ctx=context,
+    shard: Optional[str] = None,
+) -> None:
+    """Loads the config and the output columns, to write outputs without a run."""
+    model_data.load_model_data(config_file)
+    if shard is not None:
+        model_data.data["shard"] = shard
+    ctx.reinit(model_data)
+    ctx.column_name = model_data.get("column_name")
+    parser.load_prompt_data(model_data)
+    add_output_columns(ctx)
+
+
+def output_columns() -> List[str]:
+    """The output columns of the prompt rows, in their order."""
+    columns = []
+    for line in parser.get_prompt_data():
+        if line["dataOut"] and line["name"] not in columns:
+            columns.append(line["name"])
+    return columns
+
+
+def add_output_columns(ctx=context) -> None:
+    for column in output_columns():
+        if column not in ctx.ordered_column_list:
+            ctx.ordered_column_list.append(column)
+
+
+def materialize_output(
+    config_file: Union[str, os.PathLike[str]],
+    ctx=context,
+    shard: Optional[str] = None,
+) -> None:
+    """
+    Writes the csv and json outputs from the log of finished documents,
+    e.g. to look at the results of a run that is still going or crashed.
+    """
+    prepare_output(config_file, ctx, shard)
+    log_file = OutputLog.latest(get_output_log(ctx))
+    if not os.path.exists(log_file):
+        print(f"No output log {log_file} found")
+        return
+
+    final_output, debug, _ = OutputLog.read(log_file)
+    output_file, output_file_json, debug_output_file, debug_output_file_json = (
+        get_output_files(ctx)
+    )
+    save_output(final_output, output_file, output_file_json, ctx, model_data)
+    save_output(debug, debug_output_file, debug_output_file_json, ctx, model_data)
+    parquet = open_parquet_output(ctx)
+    if parquet is not None:
+        with parquet:
+            parquet.extend(final_output.items())
+    print(f"Wrote {len(final_output)} documents from {log_file}.")
@@ -2,13 +2,20 @@ import csv
 import os
 import json
 import subprocess
-import sys
 import re
-from typing import List, Dict, Any, Optional
+import shlex
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Mapping, Optional, Union, Tuple
 
 from .utils import log_traceback
 from . import utils as u
 from .parse_pubmed_json import parse_pubmed_data
+from .batch import BatchPending
+from .replay import CacheMiss
+from .prompt_template import PromptTemplate, compile_prompt
+from .prompt_cache_sqlite import CACHE_DOCUMENT
+from .output_log import DONE, FAILED, SKIPPED
 
 prechecks = {
     "is_yes": u.isYes,
@@ -37,110 +44,57 @@ prechecks = {
 }
 
 
+def render_prompt(prompt: Union[str, PromptTemplate], ctx, escape: bool = False) -> str:
+    """Fills in the [placeholders] of a prompt from ctx.data_store."""
+    template = compile_prompt(prompt)
+    return template.render(template.values(ctx.data_store, escape))
+
+
 def preprocess_prompt(
-    prompt: str,
+    prompt: Union[str, PromptTemplate],
     ctx,
     max_length: int = None,
     escape: bool = False,
-    overlap: int = 500,
 ) -> List[str]:
-    if max_length is None:
-        max_length = ctx.max_prompt_length
-    # Track original text and substitutions for splitting later if needed
-    substitutions = []
-    result = prompt
-
-    # First pass: identify all substitutions
-    for key in ctx.data_store:
-        placeholder = f"[{key}]"
-        if placeholder in result:
-            new_text = ctx.data_store[key]
-            if escape:
-                new_text = repr(new_text)
-
-            # Record information about each substitution
-            for match_pos in [
-                m.start() for m in re.finditer(f"(?={re.escape(placeholder)})", result)
-            ]:
-                substitutions.append(
-                    {
-                        "key": key,
-                        "placeholder": placeholder,
-                        "replacement": new_text,
-                        "position": match_pos,
-                        "length": len(new_text),
-                    }
-                )
-
-    # Sort substitutions by position (to maintain order)
-    substitutions.sort(key=lambda x: x["position"])
-
-    # Apply substitutions to get the processed text
-    processed_prompt = prompt
-    for sub in substitutions:
-        processed_prompt = processed_prompt.replace(
-            sub["placeholder"], sub["replacement"], 1
-        )
-
-    # If the processed prompt is within limits, return it as a single-item list
-    if len(processed_prompt) <= max_length:
-        return [processed_prompt]
-
-    # Otherwise, find the longest substitution to split
-    if not substitutions:
-        # If no substitutions but still too long, simply truncate
-        return [processed_prompt[:max_length]]
-
-    # Find the longest substitution
-    longest_sub = max(substitutions, key=lambda x: x["length"])
-
-    if longest_sub["length"] <= overlap:
-        # If even the longest substitution is too short to split meaningfully,
-        # truncate the result
-        return [processed_prompt[:max_length]]
-
-    # Split the longest substitution
-    original_text = longest_sub["replacement"]
-    split_point = len(original_text) // 2
-
-    # Ensure the split point provides proper overlap
-    part1 = original_text[: split_point + overlap]
-    part2 = original_text[split_point:]
-
-    # Create two new data stores with the split substitution
-    new_prompts = []
-
-    # For each split part, create a new prompt
-    for _, part in enumerate([part1, part2]):
-        # Create a copy of the data store with the modified substitution
-        temp_data_store = dict(ctx.data_store)
-        temp_data_store[longest_sub["key"]] = part
-
-        # Create a temporary data context
-        original_data_store = ctx.data_store
-        ctx.data_store = temp_data_store
-
-        # Recursively process with the updated substitution
-        split_results = preprocess_prompt(prompt, ctx, max_length, escape, overlap)
-        new_prompts.extend(split_results)
+    """
+    Fills in the prompt, split into chunks by ctx.chunker if it is longer
+    than the configured limit, or than max_length if given.
+    """
+    chunker = ctx.chunker
+    if max_length is not None:
+        chunker = chunker.with_limit(max_length)
+    template = compile_prompt(prompt)
+    return chunker.chunk(template, template.values(ctx.data_store, escape))
 
-        # Restore original data store
-        ctx.data_store = original_data_store
 
-    return new_prompts
+def split_document_prefix(template: PromptTemplate, ctx) -> Optional[Tuple[str, str]]:
+    """
+    For prompt_caching, moves the document text ([paper], or the other keys in
+    ctx.prompt_cache_keys) out of the prompt into a prefix that is the same for
+    every row of the document.  Returns (prefix, prompt), where the prompt
+    refers to the text as <paper>, or None if the prompt uses none of the keys.
+    """
+    values = template.values(ctx.data_store)
+    names = [name for name in ctx.prompt_cache_keys if name in values]
+    if not names:
+        return None
+    prefix = "\n\n".join(f"<{name}>\n{values[name]}\n</{name}>" for name in names)
+    prompt = template.render({**values, **{name: f"<{name}>" for name in names}})
+    return prefix, prompt
 
 
-def get_text_from_prompt(prompt: str, system: str, ctx, model_data) -> str:
+def get_text_from_prompt(
+    prompt: Union[str, PromptTemplate], system: str, ctx, model_data
+) -> str:
+    template = compile_prompt(prompt)
+    prompt = template.text
     if prompt.startswith("#py"):
         prompt = prompt[3:]
         if prompt.startswith("#python"):
             prompt = prompt[7:]
 
-        full_prompt = preprocess_prompt(
-            prompt, ctx, escape=True, max_length=sys.maxsize
-        )
+        full_prompt = render_prompt(prompt, ctx, escape=True)
         result = prompt
-        full_prompt = full_prompt[0]
 
         try:
             result = str(eval(full_prompt))
@@ -154,32 +108,63 @@ def get_text_from_prompt(prompt: str, system: str, ctx, model_data) -> str:
     # special case to indicate that the prompt should be generated but not processed
     # i.e., for retrieving variables or direct quotes from the input file
     if prompt.startswith("#"):
-        full_prompt = preprocess_prompt(prompt, ctx, max_length=sys.maxsize)
-        full_prompt = full_prompt[0]
         # more special case to call a script
         if prompt.startswith("#!"):
-            full_prompt = full_prompt[0]
-            params = full_prompt[2:].split(" ", 1)
+            # the row's arguments are split before the [placeholders] are
+            # filled in, so quotes in the document or a reply are kept as text
+            params = prompt[2:].split(" ", 1)
+            script = render_prompt(params[0], ctx)
+            args = shlex.split(params[1]) if len(params) > 1 else []
+            args = [render_prompt(arg, ctx) for arg in args]
 
             script_folder = model_data.get("script_folder", "scripts")
 
-            exe = os.path.join(script_folder, params[0])
-            params = params[1]
-            result = subprocess.run(
-                [exe, params], shell=True, text=True, capture_output=True
-            )
-            if result.returncode != 0:
-                ctx.script_returncode = result.returncode
-
-            result = result.stdout
+            exe = os.path.join(script_folder, script)
+            if script in ctx.persistent_scripts:
+                returncode, result = ctx.script_pool.run(exe, args)
+            else:
+                completed = subprocess.run([exe] + args, text=True, capture_output=True)
+                returncode, result = completed.returncode, completed.stdout
+            if returncode != 0:
+                ctx.script_returncode = returncode
 
         else:
-            result = full_prompt[1:]
+            result = render_prompt(template, ctx)[1:]
     else:
-        full_prompt = preprocess_prompt(prompt, ctx)
-        results = []
-        for pr in full_prompt:
-            results.append(ctx.llm_engine.prompt(pr, system))
+        full_prompt = preprocess_prompt(template, ctx)
+        prefix = ""
+        if ctx.prompt_caching and len(full_prompt) == 1:
+            split = split_document_prefix(template, ctx)
+            if split is not None:
+                prefix, full_prompt = split[0], [split[1]]
+        if ctx.chunk_workers > 1 and len(full_prompt) > 1:
+            # chunks are independent, send them together and keep their order
+            with ThreadPoolExecutor(
+                max_workers=min(ctx.chunk_workers, len(full_prompt))
+            ) as executor:
+                # each chunk runs in a copy of the context, for CACHE_DOCUMENT
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        ctx.llm_engine.prompt,
+                        pr,
+                        system,
+                        prefix,
+                    )
+                    for pr in full_prompt
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = []
+            pending = None
+            for pr in full_prompt:
+                try:
+                    results.append(ctx.llm_engine.prompt(pr, system, prefix))
+                except BatchPending as e:
+                    # keep going so every chunk is queued in the same batch
+                    pending = e
+            if pending is not None:
+                raise pending
         result = " ".join(results)
 
     # remove characters that are not printable, including newlines and tabs
@@ -216,7 +201,7 @@ def process_line(line: Dict[str, Any], ctx, model_data) -> Optional[str]:
 
     name = line["name"]
     if len(name) == 0 and len(line["prompts"]) == 0:
-        return ctx.data_store["reply"]
+        return ctx.data_store.get("reply", "")
 
     preCheck = None
     result = None
@@ -227,7 +212,7 @@ def process_line(line: Dict[str, Any], ctx, model_data) -> Optional[str]:
             skip_test = load_skiptest_from_py(skip_test)
             line["skipTest"] = skip_test
 
-        preCheck = line["skipPrompt"]
+        preCheck = line.get("skipTemplate", line["skipPrompt"])
         preCheckResult = get_text_from_prompt(
             preCheck, ctx.precheck_system, ctx, model_data
         )
@@ -240,13 +225,17 @@ def process_line(line: Dict[str, Any], ctx, model_data) -> Optional[str]:
             test_name = parts[0]
             param = parts[1] if len(parts) > 1 else ""
             preCheckTestFunction = prechecks.get(test_name, u.isYes)
+            if preCheckTestFunction is u.isError:
+                # the script error test reads the return code from the context
+                param = ctx
 
         # if the answer is yes, then we jump to the next stage
         # If no, we will use this prompt
         if preCheckTestFunction(preCheckResult, param):
-            return ctx.data_store["reply"]
+            # there is no reply yet if the first row is skipped
+            return ctx.data_store.get("reply", "")
 
-    for prompt in line["prompts"]:
+    for prompt in line.get("templates", line["prompts"]):
         result = get_text_from_prompt(prompt, system, ctx, model_data)
 
         if result.lower() == "!cancel!":
@@ -274,6 +263,68 @@ def process_line(line: Dict[str, Any], ctx, model_data) -> Optional[str]:
     return result
 
 
+def process_lines_concurrently(
+    prompt_data: List[Dict[str, Any]], ctx, model_data
+) -> Optional[str]:
+    """
+    Runs the prompt rows of a document on a thread pool, starting each row
+    once the rows in its "dependsOn" list have finished.  Every row runs in
+    its own line context and rows are merged back in sheet order, so the
+    data store, reply numbering and output columns match a sequential run.
+    Returns the result of the last row, or None if a row cancelled.
+    If a row was queued for a batch, the rows that do not depend on it
+    still run, then BatchPending is raised.
+    """
+    results = {}
+    started = set()
+    merged = 0
+    result = None
+    cancelled = False
+    pending = None
+
+    with ThreadPoolExecutor(max_workers=ctx.prompt_workers) as executor:
+        futures = {}
+        while merged < len(prompt_data) and not cancelled:
+            # start every row whose dependencies have been merged
+            for row, line in enumerate(prompt_data):
+                if row not in started and all(d < merged for d in line["dependsOn"]):
+                    line_ctx = ctx.line_context()
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        process_line,
+                        line,
+                        line_ctx,
+                        model_data,
+                    )
+                    futures[future] = (row, line_ctx)
+                    started.add(row)
+
+            if not futures:
+                # only rows waiting on a row queued for a batch are left
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                row, line_ctx = futures.pop(future)
+                try:
+                    results[row] = (future.result(), line_ctx)
+                except BatchPending as e:
+                    pending = e
+
+            while merged in results and not cancelled:
+                result, line_ctx = results.pop(merged)
+                if result is None:
+                    cancelled = True
+                    break
+                ctx.merge_line(line_ctx, prompt_data[merged]["name"], result)
+                merged += 1
+
+    if pending is not None:
+        raise pending
+
+    return result
+
+
 def process_document(
     pmid: str,
     document_data: Dict[str, Any],
@@ -281,6 +332,8 @@ def process_document(
     model_data,
     parser,
 ) -> Optional[Dict[str, str]]:
+    # the cached replies are linked to the document, see cache_tool export
+    token = CACHE_DOCUMENT.set(pmid)
     try:
         text = document_data["text"]
         sections = document_data["sections"]
@@ -302,23 +355,37 @@ def process_document(
         print(f"Processing {pmid}")
         prompt_data = parser.get_prompt_data()
 
-        for process in prompt_data:
+        # in batch mode rows that do not depend on a queued row keep going,
+        # and the run after the batch stages schedules the rows the same way
+        if ctx.prompt_workers > 1 or ctx.batch_mode:
+            result = process_lines_concurrently(prompt_data, ctx, model_data)
+        else:
+            for process in prompt_data:
 
-            result = process_line(process, ctx, model_data)
+                result = process_line(process, ctx, model_data)
 
-            if result is None:
-                break
+                if result is None:
+                    break
 
         if result is not None:
             result = ctx.output_data.copy()
-        ctx.debug[pmid] = ctx.data_store.copy()
+        ctx.debug[pmid] = ctx.debug_capture(ctx.data_store)
+        ctx.status = DONE
 
         return result
 
+    except BatchPending:
+        # the document carries on in the next batch stage
+        return None
+    except CacheMiss:
+        raise
     except Exception as e:
         print(f"Error processing document {pmid}: {e}")
         log_traceback(model_data.get("error_file", "error.log"))
+        ctx.status = FAILED
         return None
+    finally:
+        CACHE_DOCUMENT.reset(token)
 
 
 def get_pubmed_from_local(pubmed_id: str, model_data):
@@ -422,13 +489,29 @@ def fetch_pubmed_data(
         pubmed_id[:3] == "PMC" and pubmed_id[3:].isnumeric()
     )
 
+    # With a document store, the parsed sections are kept as well
+    store = ctx.document_store
+    if store is not None and is_pubmed:
+        parsed_data = store.get_parsed(pubmed_id, sections_to_extract)
+        if parsed_data is not None:
+            return parsed_data
+
     json_file_path = os.path.join(data_folder, f"{pubmed_id}.json")
 
+    data = store.get_raw(pubmed_id) if store is not None else None
+
     # Check if the JSON file already exists, to cache it
-    if os.path.exists(json_file_path):
+    if data is None and os.path.exists(json_file_path):
         with open(json_file_path, "r", encoding="utf-8") as json_file:
             data = json.load(json_file)
-    else:
+        if store is not None:
+            # moved over from the per-ID files
+            store.put_raw(pubmed_id, data)
+    elif data is None:
+
+        if ctx.replay is not None and is_pubmed:
+            # replay runs only from the document cache
+            ctx.replay.document_miss(pubmed_id)
 
         if is_pubmed:
 
@@ -440,12 +523,17 @@ def fetch_pubmed_data(
         else:
             data = get_text_from_local(pubmed_id, ctx)
 
-        with open(json_file_path, "w", encoding="utf-8") as json_file:
-            json.dump(data, json_file, ensure_ascii=False, indent=4)
+        if store is not None:
+            store.put_raw(pubmed_id, data)
+        else:
+            with open(json_file_path, "w", encoding="utf-8") as json_file:
+                json.dump(data, json_file, ensure_ascii=False, indent=4)
 
     # Extract the relevant sections from the JSON data
     if is_pubmed:
         parsed_data = parse_pubmed_data(data, sections_to_extract)
+        if store is not None:
+            store.put_parsed(pubmed_id, sections_to_extract, parsed_data)
     else:
         parsed_data = data
 
@@ -461,21 +549,25 @@ def process_pubmed_id(
     ctx,
     model_data,
     parser,
+    document_data: Optional[Dict[str, Any]] = None,
 ) -> None:
-    document_data = fetch_pubmed_data(
-        pubmed_id, sections_to_extract, data_folder, ctx, model_data
-    )
+    # document_data is passed in when it was prefetched
+    if document_data is None:
+        document_data = fetch_pubmed_data(
+            pubmed_id, sections_to_extract, data_folder, ctx, model_data
+        )
     document_text = document_data.get("text")
 
     print("got text", pubmed_id, len(document_text))
     # print(document_text
     if len(document_text) > ctx.max_doc_length:
         print("document too long")
+        ctx.status = SKIPPED
         return
 
     if document_text:
         if len(document_text) > 1:
-            processed_documents.append(document_text)
+            processed_documents.append(pubmed_id)
             result = process_document(pubmed_id, document_data, ctx, model_data, parser)
             if result:
                 ctx.final_output[pubmed_id] = result
@@ -486,8 +578,8 @@ def output_csv(output_data: Dict[str, Dict[str, str]], outputfile: str, ctx) ->
     # column_name is the global for the key of the dictionary
     column_name = ctx.column_name
     # Collect all possible columns from the nested dictionaries
-    for key in output_data:
-        columns.update(output_data[key].keys())
+    for values in output_data.values():
+        columns.update(values.keys())
 
     # Ensure columns appear in the specified order, filtering only those present in output_data
     ordered_columns = [col for col in ctx.ordered_column_list if col in columns]
@@ -522,12 +614,26 @@ def save_output(
 
     try:
         with open(json_file, "w", encoding="utf-8") as json_out:
-            json.dump(data, json_out, indent=4)
+            dump_json_rows(data, json_out)
     except Exception as e:
         print(f"Error saving to {json_file}: {e}")
         log_traceback(model_data.get("error_file", "error.log"))
 
 
+def dump_json_rows(data: Mapping[str, Any], json_out) -> None:
+    """
+    Writes data like json.dump(data, json_out, indent=4), one row at a time,
+    so rows read from the output log are not all held in memory.
+    """
+    json_out.write("{")
+    separator = "\n"
+    for key, values in data.items():
+        # the row as it is indented inside the outer object
+        json_out.write(separator + json.dumps({key: values}, indent=4)[2:-2])
+        separator = ",\n"
+    json_out.write("}" if separator == "\n" else "\n}")
+
+
 NEWLINE_CHARS = [
     "\r\n",  # CRLF
     "\r",  # CR
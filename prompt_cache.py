@@ -1,4 +1,5 @@
 import os
+import asyncio
 import json
 import hashlib
 from typing import Optional, Dict, Any
@@ -39,3 +40,24 @@ class PromptCache:
 
         with open(filename, "w", encoding="utf-8") as file:
             json.dump(response, file)
+
+    # Async variants run the blocking disk access in the default executor,
+    # so lookups do not stall the event loop
+    async def aget_cached_response(
+        self,
+        model_engine,
+        system: str,
+        prompt: str,
+    ) -> Optional[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.get_cached_response, model_engine, system, prompt
+        )
+
+    async def asave_response(
+        self, model_engine, system: str, prompt: str, response: Dict[str, Any]
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, self.save_response, model_engine, system, prompt, response
+        )
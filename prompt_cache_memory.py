@@ -0,0 +1,151 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class MemoryCache:
+    """
+    In-memory LRU tier in front of a persistent prompt cache, bounded by
+    entry count and by the size of the stored responses.  It has the same
+    interface as the PromptCache classes, so engines use it the same way,
+    and counts hits and misses of the memory tier.
+    """
+
+    def __init__(
+        self,
+        backend,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # tells the backend about memory hits, for its last use and links
+        self.touch = getattr(backend, "touch", None)
+
+    def __getattr__(self, name):
+        # anything else (flush, purge_old_data, ...) goes to the backend
+        return getattr(self.backend, name)
+
+    @staticmethod
+    def _key(model_engine, system: str, prompt: str) -> str:
+        # hashed so long prompts are not kept in memory as keys
+        key = "\0".join([str(model_engine), system, prompt])
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _store(self, key: str, response: Dict[str, Any]) -> None:
+        size = len(json.dumps(response))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (response, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def get_cached_response(
+        self,
+        model_engine,
+        system: str,
+        prompt: str,
+    ) -> Optional[Dict[str, Any]]:
+        key = self._key(model_engine, system, prompt)
+        response = self._lookup(key)
+        if response is None:
+            response = self.backend.get_cached_response(model_engine, system, prompt)
+            if response is not None:
+                self._store(key, response)
+        elif self.touch is not None:
+            self.touch(model_engine, system, prompt)
+        return response
+
+    def save_response(
+        self, model_engine, system: str, prompt: str, response: Dict[str, Any]
+    ) -> None:
+        self.backend.save_response(model_engine, system, prompt, response)
+        self._store(self._key(model_engine, system, prompt), response)
+
+    async def aget_cached_response(
+        self,
+        model_engine,
+        system: str,
+        prompt: str,
+    ) -> Optional[Dict[str, Any]]:
+        key = self._key(model_engine, system, prompt)
+        response = self._lookup(key)
+        if response is None:
+            response = await self.backend.aget_cached_response(
+                model_engine, system, prompt
+            )
+            if response is not None:
+                self._store(key, response)
+        elif self.touch is not None:
+            self.touch(model_engine, system, prompt)
+        return response
+
+    async def asave_response(
+        self, model_engine, system: str, prompt: str, response: Dict[str, Any]
+    ) -> None:
+        await self.backend.asave_response(model_engine, system, prompt, response)
+        self._store(self._key(model_engine, system, prompt), response)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+
+def make_prompt_cache(model_data, cache_folder: str):
+    """
+    Creates the prompt cache for an engine: the persistent backend chosen by
+    cache_backend (sqlite or files), fronted by a MemoryCache unless
+    memory_cache_entries is 0.  The sqlite backend compresses the responses
+    as set by cache_compression.
+    """
+    backend_name = str(model_data.get("cache_backend", "sqlite")).lower()
+    if backend_name == "files":
+        from .prompt_cache import PromptCache
+
+        backend = PromptCache(cache_folder)
+    elif backend_name == "sqlite":
+        from .prompt_cache_sqlite import PromptCache
+
+        backend = PromptCache(
+            cache_folder, compression=model_data.get("cache_compression", "zlib")
+        )
+    else:
+        raise ValueError(f"Unknown cache_backend '{backend_name}', use sqlite or files")
+
+    max_entries = int(model_data.get("memory_cache_entries", DEFAULT_MAX_ENTRIES))
+    if max_entries <= 0:
+        return backend
+    max_bytes = int(model_data.get("memory_cache_bytes", DEFAULT_MAX_BYTES))
+    return MemoryCache(backend, max_entries, max_bytes)
@@ -2,38 +2,169 @@ import sqlite3
 import hashlib
 import json
 import os
-from typing import Optional, Dict, Any
+import zlib
+import time
+import atexit
+import asyncio
+import threading
+import contextvars
+from typing import Optional, Dict, Any, Iterable, Tuple
+
+# Writes are grouped into one transaction per COMMIT_BATCH responses or
+# COMMIT_INTERVAL seconds, whichever comes first
+COMMIT_BATCH = 100
+COMMIT_INTERVAL = 1.0
+# How long to wait for another process holding the write lock, in seconds
+BUSY_TIMEOUT = 30
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Format of the stored response, kept per row in the format column so rows
+# written with any compression setting can be read back
+FORMAT_JSON = 0
+FORMAT_ZLIB = 1
+FORMAT_ZSTD = 2
+COMPRESSION_FORMATS = {"none": FORMAT_JSON, "zlib": FORMAT_ZLIB, "zstd": FORMAT_ZSTD}
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Rows rewritten per transaction by recompress
+MIGRATE_BATCH = 1000
+
+# ID of the document being processed, set by process_pubmed_id.  Saved and
+# used responses are linked to it so bundles can be exported per document.
+CACHE_DOCUMENT = contextvars.ContextVar("cache_document", default=None)
 
 
 class PromptCache:
     # Handles local caching of prompts using SQLite.
+    # Each thread keeps its own connection open, the database runs in WAL mode
+    # so readers do not block the writer, and several processes can share it.
 
-    def __init__(self, cache_folder="cache", cache_file="api_cache.db"):
+    def __init__(
+        self, cache_folder="cache", cache_file="api_cache.db", compression="zlib"
+    ):
         os.makedirs(cache_folder, exist_ok=True)
         db_path = os.path.join(cache_folder, cache_file)
         self.db_path = db_path
+        compression = str(compression or "none").lower()
+        if compression not in COMPRESSION_FORMATS:
+            raise ValueError(
+                f"Unknown cache_compression '{compression}', use none, zlib or zstd"
+            )
+        self.format = COMPRESSION_FORMATS[compression]
+        self._local = threading.local()
+        if self.format == FORMAT_ZSTD:
+            self._zstd()  # fail early if zstandard is missing
+        self._pending = {}
+        # Hits since the last commit, their last_access is updated with the writes
+        self._touched = set()
+        # (id, document) links since the last commit
+        self._links = set()
+        self._pending_lock = threading.Lock()
+        self._last_commit = time.monotonic()
         self._initialize_db()
+        atexit.register(self.flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            self._local.conn = conn
+        return conn
 
     def _initialize_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        conn = self._connect()
+        with conn:
+            conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS cache (
                     id TEXT PRIMARY KEY,
                     model_engine TEXT,
                     response TEXT,
-                    date TEXT DEFAULT CURRENT_TIMESTAMP
+                    date TEXT DEFAULT CURRENT_TIMESTAMP,
+                    last_access TEXT DEFAULT CURRENT_TIMESTAMP,
+                    format INTEGER DEFAULT 0
+                )
+            """
+            )
+            # Caches created by earlier versions
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+            for column, definition, fill in [
+                ("last_access", "TEXT", "UPDATE cache SET last_access = date"),
+                ("format", "INTEGER DEFAULT 0", None),
+            ]:
+                if column in columns:
+                    continue
+                try:
+                    conn.execute(f"ALTER TABLE cache ADD COLUMN {column} {definition}")
+                    if fill:
+                        conn.execute(fill)
+                except sqlite3.OperationalError as e:
+                    # another process added it first
+                    if "duplicate column" not in str(e):
+                        raise
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_last_access ON cache(last_access)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_date ON cache(date)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache_documents (
+                    id TEXT,
+                    document TEXT,
+                    PRIMARY KEY (id, document)
                 )
             """
             )
-            conn.commit()
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_documents_document"
+                " ON cache_documents(document)"
+            )
 
     def _generate_hash(self, model_engine, system: str, prompt: str) -> str:
 
         hashkey = ".".join(["prompt-caching-v1", str(model_engine), system, prompt])
         return hashlib.md5(hashkey.encode()).hexdigest()
 
+    def _zstd(self):
+        # zstandard objects are not thread safe, each thread has its own
+        codecs = getattr(self._local, "zstd", None)
+        if codecs is None:
+            try:
+                import zstandard
+            except ModuleNotFoundError as e:
+                raise ValueError(
+                    "To use zstd cache compression zstandard must be installed"
+                ) from e
+            codecs = (
+                zstandard.ZstdCompressor(level=ZSTD_LEVEL),
+                zstandard.ZstdDecompressor(),
+            )
+            self._local.zstd = codecs
+        return codecs
+
+    def _encode(self, response: Dict[str, Any], format: Optional[int] = None):
+        """Returns the stored value of a response, in the given or default format."""
+        if format is None:
+            format = self.format
+        data = json.dumps(response)
+        if format == FORMAT_ZLIB:
+            return zlib.compress(data.encode(), ZLIB_LEVEL)
+        if format == FORMAT_ZSTD:
+            return self._zstd()[0].compress(data.encode())
+        return data
+
+    def _decode(self, value, format: Optional[int]) -> Dict[str, Any]:
+        if format == FORMAT_ZLIB:
+            value = zlib.decompress(value)
+        elif format == FORMAT_ZSTD:
+            value = self._zstd()[1].decompress(value)
+        elif format not in (FORMAT_JSON, None):
+            raise ValueError(f"Unknown cache format {format} in {self.db_path}")
+        return json.loads(value)
+
     def get_cached_response(
         self,
         model_engine,
@@ -42,28 +173,310 @@ class PromptCache:
     ) -> Optional[Dict[str, Any]]:
         hash_value = self._generate_hash(model_engine, system, prompt)
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT response FROM cache WHERE id = ?", (hash_value,))
-            result = cursor.fetchone()
+        # Responses not yet committed are answered from memory
+        with self._pending_lock:
+            pending = self._pending.get(hash_value)
+        if pending is not None:
+            return self._decode(pending[1], self.format)
+
+        self._flush_if_due()
 
-            if result:
-                return json.loads(result[0])  # Convert string back to JSON
-            return None  # No cached response found
+        cursor = self._connect().execute(
+            "SELECT response, format FROM cache WHERE id = ?", (hash_value,)
+        )
+        result = cursor.fetchone()
 
-    def purge_old_data(self, cutoff_date, model_engine=None) -> None:
+        if result:
+            self._use(hash_value)
+            return self._decode(*result)
+        return None  # No cached response found
+
+    def _use(self, hash_value: str) -> None:
+        document = CACHE_DOCUMENT.get()
+        with self._pending_lock:
+            self._touched.add(hash_value)
+            if document is not None:
+                self._links.add((hash_value, document))
+
+    def touch(self, model_engine, system: str, prompt: str) -> None:
+        """Records a use of a response answered from a cache in front of this one."""
+        self._use(self._generate_hash(model_engine, system, prompt))
+
+    def purge_old_data(self, cutoff_date, model_engine=None) -> int:
         # Removes old rows, optionally a specific model
+        return self.prune(created_before=cutoff_date, model_engine=model_engine)
+
+    def prune(
+        self, created_before=None, accessed_before=None, model_engine=None
+    ) -> int:
+        """
+        Removes the responses matching all the given conditions: saved before
+        created_before, last used before accessed_before, and model_engine
+        (a LIKE pattern, e.g. "gpt-4%"). Dates are "YYYY-MM-DD HH:MM:SS" UTC.
+        Returns the number of responses removed.
+        """
+        conditions = []
+        params = []
+        if created_before:
+            conditions.append("date < ?")
+            params.append(str(created_before))
+        if accessed_before:
+            conditions.append("last_access < ?")
+            params.append(str(accessed_before))
+        if model_engine:
+            conditions.append("model_engine LIKE ?")
+            params.append(str(model_engine))
+        if not conditions:
+            raise ValueError("prune needs at least one condition")
+
+        self.flush()
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM cache WHERE " + " AND ".join(conditions), params
+            )
+            self._remove_orphan_links(conn)
+        return cursor.rowcount
+
+    def enforce_size_limit(self, max_bytes: int) -> int:
+        """
+        Removes the least recently used responses until the stored responses
+        take at most max_bytes. Returns the number of responses removed.
+        """
+        self.flush()
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                """
+                DELETE FROM cache WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, SUM(length(CAST(response AS BLOB))) OVER (
+                            ORDER BY last_access DESC, id
+                        ) AS total
+                        FROM cache
+                    ) WHERE total > ?
+                )
+            """,
+                (int(max_bytes),),
+            )
+            self._remove_orphan_links(conn)
+        return cursor.rowcount
+
+    @staticmethod
+    def _remove_orphan_links(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "DELETE FROM cache_documents WHERE id NOT IN (SELECT id FROM cache)"
+        )
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            if model_engine:
-                cursor.execute(
-                    "DELETE FROM cache WHERE date < ? and model_engine LIKE ",
-                    (cutoff_date, model_engine),
+    def vacuum(self) -> None:
+        """Rebuilds the database file, returning the space of removed rows to the disk."""
+        self.flush()
+        conn = self._connect()
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def recompress(self) -> int:
+        """
+        Rewrites the responses stored in another format in this cache's
+        compression, MIGRATE_BATCH rows per transaction so other processes
+        can keep using the cache. Returns the number of rows rewritten.
+        Run vacuum afterwards to return the saved space to the disk.
+        """
+        self.flush()
+        conn = self._connect()
+        rewritten = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, response, format FROM cache"
+                " WHERE format IS NOT ? LIMIT ?",
+                (self.format, MIGRATE_BATCH),
+            ).fetchall()
+            if not rows:
+                return rewritten
+            with conn:
+                conn.executemany(
+                    "UPDATE cache SET response = ?, format = ? WHERE id = ?",
+                    [
+                        (self._encode(self._decode(value, format)), self.format, id)
+                        for id, value, format in rows
+                    ],
                 )
-            else:
-                cursor.execute("DELETE FROM cache WHERE date < ?", (cutoff_date,))
-            conn.commit()
+            rewritten += len(rows)
+
+    def file_size(self) -> int:
+        return sum(
+            os.path.getsize(path)
+            for path in (self.db_path, self.db_path + "-wal")
+            if os.path.exists(path)
+        )
+
+    def statistics(self) -> Dict[str, Any]:
+        """Number and size of the cached responses, in total and per model."""
+        self.flush()
+        conn = self._connect()
+        models = {}
+        for model_engine, entries, size, oldest, newest, last_access in conn.execute(
+            """
+            SELECT model_engine, COUNT(*), SUM(length(CAST(response AS BLOB))),
+                   MIN(date), MAX(date), MAX(last_access)
+            FROM cache GROUP BY model_engine ORDER BY model_engine
+        """
+        ):
+            models[model_engine] = {
+                "entries": entries,
+                "bytes": size or 0,
+                "oldest": oldest,
+                "newest": newest,
+                "last_access": last_access,
+            }
+        names = {value: name for name, value in COMPRESSION_FORMATS.items()}
+        formats = {
+            names.get(format, str(format)): count
+            for format, count in conn.execute(
+                "SELECT format, COUNT(*) FROM cache GROUP BY format"
+            )
+        }
+        return {
+            "entries": sum(m["entries"] for m in models.values()),
+            "formats": formats,
+            "bytes": sum(m["bytes"] for m in models.values()),
+            "file_bytes": self.file_size(),
+            "models": models,
+        }
+
+    def export_bundle(
+        self,
+        bundle_path: str,
+        documents: Optional[Iterable[str]] = None,
+        model_engine=None,
+        created_after=None,
+        created_before=None,
+    ) -> int:
+        """
+        Copies the responses matching all the given conditions into the
+        cache table of the SQLite file bundle_path, with their links to the
+        documents: used for one of documents, model_engine (a LIKE pattern),
+        and saved between created_after and created_before.
+        Returns the number of responses exported.
+        """
+        conditions = []
+        params = []
+        if created_after:
+            conditions.append("date >= ?")
+            params.append(str(created_after))
+        if created_before:
+            conditions.append("date < ?")
+            params.append(str(created_before))
+        if model_engine:
+            conditions.append("model_engine LIKE ?")
+            params.append(str(model_engine))
+
+        self.flush()
+        conn = self._connect()
+        conn.execute("ATTACH DATABASE ? AS bundle", (bundle_path,))
+        try:
+            with conn:
+                self._create_bundle_tables(conn)
+                links = "main.cache_documents"
+                if documents is not None:
+                    conn.execute(
+                        "CREATE TEMP TABLE IF NOT EXISTS export_documents"
+                        " (document TEXT PRIMARY KEY)"
+                    )
+                    conn.execute("DELETE FROM temp.export_documents")
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO temp.export_documents VALUES (?)",
+                        ((str(document),) for document in documents),
+                    )
+                    links = """(SELECT * FROM main.cache_documents WHERE document IN
+                        (SELECT document FROM temp.export_documents))"""
+                    conditions.append(f"id IN (SELECT id FROM {links})")
+                where = " WHERE " + " AND ".join(conditions) if conditions else ""
+                cursor = conn.execute(
+                    f"""
+                    INSERT OR REPLACE INTO bundle.cache
+                        (id, model_engine, response, date, last_access, format)
+                    SELECT id, model_engine, response, date, last_access, format
+                    FROM main.cache{where}
+                """,
+                    params,
+                )
+                exported = cursor.rowcount
+                conn.execute(
+                    f"""
+                    INSERT OR IGNORE INTO bundle.cache_documents (id, document)
+                    SELECT id, document FROM {links}
+                    WHERE id IN (SELECT id FROM bundle.cache)
+                """
+                )
+        finally:
+            conn.execute("DETACH DATABASE bundle")
+        return exported
+
+    def import_bundle(self, bundle_path: str) -> Tuple[int, int]:
+        """
+        Merges the responses of a bundle written by export_bundle into this
+        cache.  A response already cached is replaced only if the bundle's
+        copy was saved later.  Returns the numbers of responses added and
+        replaced.
+        """
+        self.flush()
+        conn = self._connect()
+        conn.execute("ATTACH DATABASE ? AS bundle", (bundle_path,))
+        try:
+            with conn:
+                added = conn.execute(
+                    "SELECT COUNT(*) FROM bundle.cache"
+                    " WHERE id NOT IN (SELECT id FROM main.cache)"
+                ).fetchone()[0]
+                # WHERE true avoids the parsing ambiguity of an upsert after SELECT
+                cursor = conn.execute(
+                    """
+                    INSERT INTO main.cache
+                        (id, model_engine, response, date, last_access, format)
+                    SELECT id, model_engine, response, date, last_access, format
+                    FROM bundle.cache WHERE true
+                    ON CONFLICT(id) DO UPDATE SET model_engine=excluded.model_engine,
+                        response=excluded.response, format=excluded.format,
+                        date=excluded.date,
+                        last_access=MAX(last_access, excluded.last_access)
+                    WHERE excluded.date > main.cache.date
+                """
+                )
+                changed = cursor.rowcount
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO main.cache_documents (id, document)
+                    SELECT id, document FROM bundle.cache_documents
+                """
+                )
+        finally:
+            conn.execute("DETACH DATABASE bundle")
+        return added, changed - added
+
+    @staticmethod
+    def _create_bundle_tables(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bundle.cache (
+                id TEXT PRIMARY KEY,
+                model_engine TEXT,
+                response TEXT,
+                date TEXT,
+                last_access TEXT,
+                format INTEGER DEFAULT 0
+            )
+        """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bundle.cache_documents (
+                id TEXT,
+                document TEXT,
+                PRIMARY KEY (id, document)
+            )
+        """
+        )
 
     def save_response(
         self,
@@ -74,16 +487,89 @@ class PromptCache:
     ) -> None:
 
         hash_value = self._generate_hash(model_engine, system, prompt)
-        response_json = json.dumps(response)  # Convert to JSON string
+        value = self._encode(response)
+        document = CACHE_DOCUMENT.get()
+
+        with self._pending_lock:
+            self._pending[hash_value] = (model_engine, value)
+            if document is not None:
+                self._links.add((hash_value, document))
+            full = len(self._pending) >= COMMIT_BATCH
+
+        if full:
+            self.flush()
+        else:
+            self._flush_if_due()
+
+    def _flush_if_due(self) -> None:
+        if (
+            self._pending or self._touched or self._links
+        ) and time.monotonic() - self._last_commit >= COMMIT_INTERVAL:
+            self.flush()
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+    def flush(self) -> None:
+        """Writes the pending responses and access times in a single transaction."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            touched, self._touched = self._touched, set()
+            links, self._links = self._links, set()
+            self._last_commit = time.monotonic()
+        if not pending and not touched and not links:
+            return
+
+        conn = self._connect()
+        with conn:
+            conn.executemany(
                 """
-                INSERT INTO cache (id, model_engine, response)
-                VALUES (?, ?, ?)
-                ON CONFLICT(id) DO UPDATE SET response=excluded.response
+                INSERT INTO cache (id, model_engine, response, format)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET response=excluded.response,
+                    format=excluded.format, date=CURRENT_TIMESTAMP,
+                    last_access=CURRENT_TIMESTAMP
             """,
-                (hash_value, model_engine, response_json),
+                [
+                    (hash_value, model_engine, value, self.format)
+                    for hash_value, (model_engine, value) in pending.items()
+                ],
+            )
+            conn.executemany(
+                "UPDATE cache SET last_access = CURRENT_TIMESTAMP WHERE id = ?",
+                [(hash_value,) for hash_value in touched - pending.keys()],
             )
-            conn.commit()
+            conn.executemany(
+                "INSERT OR IGNORE INTO cache_documents (id, document) VALUES (?, ?)",
+                links,
+            )
+
+    # Async variants run the blocking disk access in the default executor,
+    # so lookups do not stall the event loop.  They run in a copy of the
+    # context to keep CACHE_DOCUMENT.
+    async def aget_cached_response(
+        self,
+        model_engine,
+        system: str,
+        prompt: str,
+    ) -> Optional[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            contextvars.copy_context().run,
+            self.get_cached_response,
+            model_engine,
+            system,
+            prompt,
+        )
+
+    async def asave_response(
+        self, model_engine, system: str, prompt: str, response: Dict[str, Any]
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            contextvars.copy_context().run,
+            self.save_response,
+            model_engine,
+            system,
+            prompt,
+            response,
+        )
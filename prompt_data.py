@@ -1,6 +1,7 @@
 import csv
 import json
 import os
+import re
 
 try:
     import openpyxl
@@ -8,6 +9,9 @@ except ImportError:
     print("To use an Excel file openpyxl must be installed.")
 
 from .utils import isYes
+from .prompt_template import compile_prompt
+
+REPLY_N_RE = re.compile(r"reply_\d+")
 
 
 # parses the prompts spreadsheet into the data format already used
@@ -110,11 +114,73 @@ class PromptDataParser:
             return self.read_prompt_tsv(file_path, delimiter=",")
         return self.read_prompt_tsv(file_path)
 
+    def build_dependencies(self, prompts):
+        """
+        Sets "dependsOn" on each row: the indices of earlier rows it needs to
+        have finished before it can run.  A row depends on the latest earlier
+        row for each [name] it references.  Rows that use the previous reply
+        ([reply] before their own first prompt, or any [reply_N]) depend on
+        every earlier row, as do rows with no name and no prompts.  A row
+        with a skipPrompt or skipTest depends on the row before it, since
+        when it is skipped it passes on that row's reply, and on every
+        earlier #! script row, whose return code the test can read.
+        """
+        for i, prompt_dict in enumerate(prompts):
+            depends_on = set()
+            barrier = len(prompt_dict["name"]) == 0 and not prompt_dict["prompts"]
+
+            # [reply] in later prompts of a row is that row's own reply
+            leading = [prompt_dict["skipPrompt"]] + prompt_dict["prompts"][:1]
+            if any("[reply]" in text for text in leading):
+                barrier = True
+
+            for text in prompt_dict["prompts"] + [prompt_dict["skipPrompt"]]:
+                for ref in compile_prompt(text).names:
+                    if REPLY_N_RE.fullmatch(ref):
+                        barrier = True
+                    elif ref != "reply":
+                        for j in range(i - 1, -1, -1):
+                            if prompts[j]["name"] == ref:
+                                depends_on.add(j)
+                                break
+
+            if (prompt_dict["skipPrompt"] or prompt_dict["skipTest"]) and i > 0:
+                depends_on.add(i - 1)
+                # a skipTest can read the return code of any earlier script
+                depends_on.update(
+                    j
+                    for j in range(i - 1)
+                    if any(
+                        text.startswith("#!")
+                        for text in prompts[j]["prompts"] + [prompts[j]["skipPrompt"]]
+                    )
+                )
+
+            if barrier:
+                depends_on = set(range(i))
+            prompt_dict["dependsOn"] = sorted(depends_on)
+
+        return prompts
+
+    def compile_templates(self, prompts):
+        """
+        Compiles each row's prompts and skipPrompt once into "templates" and
+        "skipTemplate", with their [placeholder] positions found up front.
+        """
+        for prompt_dict in prompts:
+            prompt_dict["templates"] = [
+                compile_prompt(text) for text in prompt_dict["prompts"]
+            ]
+            prompt_dict["skipTemplate"] = compile_prompt(prompt_dict["skipPrompt"])
+
+        return prompts
+
     def load_prompt_data(self, model_data):
         self.prompt_data = model_data.resolve_path(model_data.get("prompt_data"))
         print("load prompts from", self.prompt_data)
 
-        self.prompt_data = self.read_prompt(self.prompt_data)
+        prompts = self.compile_templates(self.read_prompt(self.prompt_data))
+        self.prompt_data = self.build_dependencies(prompts)
 
     def get_prompt_data(self):
         return self.prompt_data
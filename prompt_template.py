@@ -0,0 +1,59 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple, Union, Optional
+
+PLACEHOLDER_RE = re.compile(r"\[([^\[\]]+)\]")
+
+
+class PromptTemplate:
+    """
+    A prompt split once into its literal text and [placeholder] names, so that
+    filling it in is a single join instead of a search per data_store key.
+    literals has one more item than names: the text before, between and
+    after the placeholders.  Placeholders without a value are left as they are.
+    """
+
+    __slots__ = ("text", "literals", "names")
+
+    def __init__(self, text: str):
+        self.text = text
+        parts = PLACEHOLDER_RE.split(text)
+        self.literals: List[str] = parts[0::2]
+        self.names: List[str] = parts[1::2]
+
+    def __repr__(self) -> str:
+        return f"PromptTemplate({self.text!r})"
+
+    def values(self, data_store: Dict[str, str], escape: bool = False):
+        """The values of the placeholders found in data_store, repr'd if escape."""
+        values = {}
+        for name in self.names:
+            if name in data_store and name not in values:
+                values[name] = repr(data_store[name]) if escape else data_store[name]
+        return values
+
+    def occurrences(self, values: Dict[str, str]) -> List[Tuple[str, str]]:
+        """(name, value) of each filled placeholder, in order of position."""
+        return [(name, values[name]) for name in self.names if name in values]
+
+    def render(self, values: Dict[str, str]) -> str:
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            value = values.get(name)
+            parts.append(f"[{name}]" if value is None else value)
+            parts.append(literal)
+        return "".join(parts)
+
+
+@lru_cache(maxsize=4096)
+def _compile(text: str) -> PromptTemplate:
+    return PromptTemplate(text)
+
+
+def compile_prompt(
+    prompt: Union[str, PromptTemplate, None]
+) -> Optional[PromptTemplate]:
+    """Returns the template of a prompt, compiling plain strings (cached)."""
+    if prompt is None or isinstance(prompt, PromptTemplate):
+        return prompt
+    return _compile(str(prompt))
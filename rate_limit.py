@@ -0,0 +1,254 @@
+import re
+import time
+import asyncio
+import threading
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, Mapping
+
+SECONDS_PER_MINUTE = 60.0
+
+# Header names used by the providers for the remaining budget and reset time
+REMAINING_REQUESTS_HEADERS = (
+    "x-ratelimit-remaining-requests",
+    "anthropic-ratelimit-requests-remaining",
+)
+REMAINING_TOKENS_HEADERS = (
+    "x-ratelimit-remaining-tokens",
+    "anthropic-ratelimit-tokens-remaining",
+    "anthropic-ratelimit-input-tokens-remaining",
+)
+RESET_REQUESTS_HEADERS = (
+    "x-ratelimit-reset-requests",
+    "anthropic-ratelimit-requests-reset",
+)
+RESET_TOKENS_HEADERS = (
+    "x-ratelimit-reset-tokens",
+    "anthropic-ratelimit-tokens-reset",
+    "anthropic-ratelimit-input-tokens-reset",
+)
+
+duration_re = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset(value: str) -> Optional[float]:
+    """
+    Returns the number of seconds until a reset header value, which is either
+    a duration like "6m0s" / "20ms" (OpenAI) or an RFC 3339 time (Anthropic).
+    """
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = duration_re.findall(value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        return sum(float(n) * DURATION_UNITS[u] for n, u in parts)
+
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _first_header(headers: Mapping[str, str], names) -> Optional[str]:
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            return value
+    return None
+
+
+def _per_minute(limit) -> Optional[float]:
+    return float(limit) if limit else None
+
+
+class RateLimiter:
+    """
+    Token buckets for a requests per minute and a tokens per minute budget,
+    shared by every engine calling the same model.  Callers wait in acquire()
+    until the request fits both budgets, instead of hitting rate limit
+    errors.  The buckets are corrected from the rate limit headers returned
+    by the provider.  The provider's remaining budget does not count the
+    requests still in flight, so these are tracked from acquire() until
+    the request is released, and taken off the remaining budget.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        self.requests_per_minute = _per_minute(requests_per_minute)
+        self.tokens_per_minute = _per_minute(tokens_per_minute)
+        self.requests = self.requests_per_minute or 0.0
+        self.tokens = self.tokens_per_minute or 0.0
+        self.in_flight_requests = 0
+        self.in_flight_tokens = 0
+        self.blocked_until = 0.0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.requests_per_minute:
+            self.requests = min(
+                self.requests_per_minute,
+                self.requests + elapsed * self.requests_per_minute / SECONDS_PER_MINUTE,
+            )
+        if self.tokens_per_minute:
+            self.tokens = min(
+                self.tokens_per_minute,
+                self.tokens + elapsed * self.tokens_per_minute / SECONDS_PER_MINUTE,
+            )
+
+    def _reserve(self, tokens: int) -> float:
+        """Takes the budget for a request and returns 0, or the time to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            wait = self.blocked_until - now
+            if self.requests_per_minute and self.requests < 1:
+                wait = max(
+                    wait,
+                    (1 - self.requests) * SECONDS_PER_MINUTE / self.requests_per_minute,
+                )
+            if self.tokens_per_minute:
+                # a request bigger than the whole budget waits for a full bucket
+                needed = min(tokens, self.tokens_per_minute)
+                if self.tokens < needed:
+                    wait = max(
+                        wait,
+                        (needed - self.tokens)
+                        * SECONDS_PER_MINUTE
+                        / self.tokens_per_minute,
+                    )
+            if wait > 0:
+                return wait
+
+            if self.requests_per_minute:
+                self.requests -= 1
+            if self.tokens_per_minute:
+                self.tokens -= tokens
+            self.in_flight_requests += 1
+            self.in_flight_tokens += tokens
+            return 0.0
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Blocks until a request of about `tokens` tokens can be sent."""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """Async version of acquire, waits with asyncio.sleep."""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, tokens: int = 0) -> None:
+        """Marks a request acquired for `tokens` tokens as no longer in flight."""
+        with self.lock:
+            self._release(tokens)
+
+    def _release(self, tokens: int) -> None:
+        self.in_flight_requests = max(0, self.in_flight_requests - 1)
+        self.in_flight_tokens = max(0, self.in_flight_tokens - tokens)
+
+    def settle(self, estimated: int, used: Optional[int]) -> None:
+        """Corrects the token bucket once the actual usage of a request is known."""
+        if used is None or not self.tokens_per_minute:
+            return
+        with self.lock:
+            self.tokens -= used - estimated
+
+    def update_from_headers(
+        self, headers: Optional[Mapping[str, str]], tokens: int = 0
+    ) -> None:
+        """
+        Releases the request of about `tokens` tokens the headers came with,
+        and lowers the buckets to the remaining budget reported by the
+        provider, less the requests still in flight, if that is below them.
+        """
+        with self.lock:
+            self._release(tokens)
+            if not headers:
+                return
+
+            now = time.monotonic()
+            self._refill(now)
+
+            retry_after = headers.get("retry-after")
+            if retry_after is not None:
+                delay = parse_reset(retry_after)
+                if delay:
+                    self.blocked_until = max(self.blocked_until, now + delay)
+
+            for remaining_names, reset_names, attr, in_flight in (
+                (
+                    REMAINING_REQUESTS_HEADERS,
+                    RESET_REQUESTS_HEADERS,
+                    "requests",
+                    self.in_flight_requests,
+                ),
+                (
+                    REMAINING_TOKENS_HEADERS,
+                    RESET_TOKENS_HEADERS,
+                    "tokens",
+                    self.in_flight_tokens,
+                ),
+            ):
+                remaining = _first_header(headers, remaining_names)
+                if remaining is None:
+                    continue
+                try:
+                    remaining = float(remaining)
+                except ValueError:
+                    continue
+
+                setattr(self, attr, min(getattr(self, attr), remaining - in_flight))
+                if remaining <= 0:
+                    reset = _first_header(headers, reset_names)
+                    delay = parse_reset(reset) if reset is not None else None
+                    if delay:
+                        self.blocked_until = max(self.blocked_until, now + delay)
+
+
+_limiters: Dict[Any, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(
+    key,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+) -> RateLimiter:
+    """
+    Returns the rate limiter shared by all engines using `key`.  The limits
+    are set by the first engine, a warning is printed if a later one asks
+    for different limits.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            _limiters[key] = limiter
+            return limiter
+
+    requested = (_per_minute(requests_per_minute), _per_minute(tokens_per_minute))
+    current = (limiter.requests_per_minute, limiter.tokens_per_minute)
+    if requested != current:
+        print(
+            f"Warning: the rate limiter for {key} already has "
+            f"requests_per_minute={current[0]} and tokens_per_minute={current[1]}, "
+            f"ignoring {requested[0]} and {requested[1]}"
+        )
+    return limiter
@@ -0,0 +1,62 @@
+import threading
+from typing import Optional, Dict, Any
+
+REPLAY_MODES = ("fail", "mark")
+# Reply used in place of a prompt missing from the cache in "mark" mode
+MISSING_REPLY = "!cache miss!"
+
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a prompt or document is not cached."""
+
+
+class Replay:
+    """
+    Offline replay: every reply comes from the prompt cache and every
+    document from the document cache, nothing is sent to a model or fetched.
+    A miss stops the run in "fail" mode, or in "mark" mode the reply becomes
+    MISSING_REPLY and a missing document is skipped.  Hits and misses are
+    counted for the report at the end of the run.
+    """
+
+    def __init__(self, mode: str):
+        mode = str(mode).lower()
+        if mode not in REPLAY_MODES:
+            raise ValueError(f"Unknown replay mode '{mode}', use fail or mark")
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.missing_documents = 0
+        self.lock = threading.Lock()
+
+    def check(
+        self, model_engine, prompt: str, cached: Optional[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """
+        Called by the engines after the cache lookup, instead of calling the
+        model.  Returns the cached reply, or the marked reply for a miss.
+        """
+        with self.lock:
+            if cached:
+                self.hits += 1
+                return cached
+            self.misses += 1
+        if self.mode == "fail":
+            raise CacheMiss(f"No cached {model_engine} reply for: {prompt[:200]!r}")
+        return {"message": {"role": "assistant", "content": MISSING_REPLY}}
+
+    def document_miss(self, document_id: str) -> None:
+        with self.lock:
+            self.missing_documents += 1
+        if self.mode == "fail":
+            raise CacheMiss(f"Document {document_id} is not in the document cache")
+        # skipped like a missing local file
+        raise FileNotFoundError(f"{document_id} is not in the document cache")
+
+    def summary(self) -> str:
+        with self.lock:
+            total = self.hits + self.misses
+            text = f"{self.hits} of {total} prompts found in the cache"
+            if self.missing_documents:
+                text += f", {self.missing_documents} documents not cached"
+        return text
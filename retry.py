@@ -1,24 +1,38 @@
 import math
 import time
+import asyncio
 import functools
 
 
+def _num_tries(num_tries, timeout, max_timeout):
+    if num_tries is None:
+        return math.ceil(math.log(max_timeout / timeout, 2)) + 1
+    return num_tries
+
+
 def retry(
-    func=None, *, num_tries=None, timeout=2, max_timeout=3600, exceptions=(Exception,)
+    func=None,
+    *,
+    num_tries=None,
+    timeout=2,
+    max_timeout=3600,
+    exceptions=(Exception,),
+    give_up=(),
 ):
+    # Exceptions in give_up are raised straight away, even if they are also
+    # listed in exceptions
     def deco(f):
         @functools.wraps(f)
         def wrap(*args, **kwargs):
-            if num_tries is None:
-                tries = math.ceil(math.log(max_timeout / timeout, 2)) + 1
-            else:
-                tries = num_tries
+            tries = _num_tries(num_tries, timeout, max_timeout)
             delay = timeout
             last_e = None
 
             for _ in range(tries):
                 try:
                     return f(*args, **kwargs)
+                except give_up:
+                    raise
                 except exceptions as e:
                     print(
                         f"In function {f} caught exception {e}, retrying in {delay} seconds."
@@ -34,3 +48,43 @@ def retry(
         return deco
     else:
         return deco(func)
+
+
+def aretry(
+    func=None,
+    *,
+    num_tries=None,
+    timeout=2,
+    max_timeout=3600,
+    exceptions=(Exception,),
+    give_up=(),
+):
+    # Same as retry, for coroutines - backs off with asyncio.sleep so the
+    # event loop keeps serving other requests while this one waits
+    def deco(f):
+        @functools.wraps(f)
+        async def wrap(*args, **kwargs):
+            tries = _num_tries(num_tries, timeout, max_timeout)
+            delay = timeout
+            last_e = None
+
+            for _ in range(tries):
+                try:
+                    return await f(*args, **kwargs)
+                except give_up:
+                    raise
+                except exceptions as e:
+                    print(
+                        f"In function {f} caught exception {e}, retrying in {delay} seconds."
+                    )
+                    last_e = e
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, max_timeout)
+            raise last_e
+
+        return wrap
+
+    if func is None:
+        return deco
+    else:
+        return deco(func)
@@ -0,0 +1,200 @@
+import json
+import atexit
+import asyncio
+import subprocess
+import threading
+from concurrent.futures import Future, InvalidStateError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import List, Dict, Any, Optional, Tuple
+
+# Seconds to wait for a reply before the script is restarted, 0 waits forever
+DEFAULT_SCRIPT_TIMEOUT = 600
+
+
+class PersistentScript:
+    """
+    Runs a script once and exchanges newline-delimited JSON with it over
+    stdin/stdout.  Each request gets an "id" which the script copies into its
+    response line, so several requests can be in flight at once and the
+    script may answer them in any order.  If the script exits it is started
+    again on the next request.  A request that gets no reply within timeout
+    seconds kills the script, failing every request in flight, so a hung
+    script is restarted instead of blocking its callers.
+    """
+
+    def __init__(
+        self,
+        command: List[str],
+        cwd: Optional[str] = None,
+        timeout: float = DEFAULT_SCRIPT_TIMEOUT,
+    ):
+        self.command = command
+        self.cwd = cwd
+        self.timeout = timeout or None
+        self.process = None
+        self.pending: Dict[int, Future] = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _start(self) -> subprocess.Popen:
+        process = subprocess.Popen(
+            self.command,
+            cwd=self.cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            bufsize=1,
+        )
+        reader = threading.Thread(
+            target=self._read_responses, args=(process,), daemon=True
+        )
+        reader.start()
+        return process
+
+    def _read_responses(self, process: subprocess.Popen) -> None:
+        for line in process.stdout:
+            if not line.strip():
+                continue
+            try:
+                response = json.loads(line)
+                future = self.pending.pop(response["id"])
+            except (ValueError, KeyError, TypeError):
+                print(f"Ignoring unexpected output from {self.command[0]}: {line}")
+                continue
+            try:
+                future.set_result(response)
+            except InvalidStateError:
+                # the caller gave up on it
+                pass
+
+        returncode = process.wait()
+        with self.lock:
+            if self.process is not process and self.process is not None:
+                # killed and replaced, its requests were failed then
+                return
+            self.process = None
+            failed = list(self.pending.values())
+            self.pending.clear()
+        self._fail(failed, f"{self.command[0]} exited with code {returncode}")
+
+    @staticmethod
+    def _fail(futures: List[Future], message: str) -> None:
+        for future in futures:
+            try:
+                future.set_exception(RuntimeError(message))
+            except InvalidStateError:
+                pass
+
+    def _timed_out(self) -> RuntimeError:
+        """Kills the script and fails its requests, it starts again on the next one."""
+        message = f"{self.command[0]} did not reply within {self.timeout} seconds"
+        with self.lock:
+            process, self.process = self.process, None
+            failed = list(self.pending.values())
+            self.pending.clear()
+        if process is not None:
+            process.kill()
+        self._fail(failed, message)
+        return RuntimeError(message)
+
+    def submit(self, payload: Dict[str, Any]) -> Future:
+        """Sends a request and returns a future for the response dict."""
+        future = Future()
+        with self.lock:
+            if self.process is None:
+                self.process = self._start()
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = future
+            try:
+                self.process.stdin.write(json.dumps({"id": request_id, **payload}))
+                self.process.stdin.write("\n")
+                self.process.stdin.flush()
+            except OSError as e:
+                self.pending.pop(request_id, None)
+                future.set_exception(
+                    RuntimeError(f"Could not write to {self.command[0]}: {e}")
+                )
+        return future
+
+    def request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return self.submit(payload).result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise self._timed_out() from None
+
+    async def arequest(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Async version of request."""
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(self.submit(payload)), self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise self._timed_out() from None
+
+    def close(self) -> None:
+        with self.lock:
+            process, self.process = self.process, None
+        if process is not None:
+            try:
+                process.stdin.close()
+                process.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+
+
+class ScriptPool:
+    """
+    Runs `#!` prompt scripts declared as persistent.  Each script is started
+    up to `size` times and kept running; an invocation is sent as one JSON
+    line {"id": ..., "args": [...]} to the process with the fewest requests
+    in flight, which answers {"id": ..., "returncode": ..., "stdout": ...}.
+    A process that does not answer within timeout seconds is restarted and
+    its invocations return code 1, like a failed one-off script.
+    """
+
+    def __init__(
+        self,
+        size: int = 1,
+        cwd: Optional[str] = None,
+        timeout: float = DEFAULT_SCRIPT_TIMEOUT,
+    ):
+        self.size = size
+        self.cwd = cwd
+        self.timeout = timeout
+        self.workers: Dict[str, List[PersistentScript]] = {}
+        self.lock = threading.Lock()
+
+    def _pick_worker(self, exe: str) -> PersistentScript:
+        with self.lock:
+            workers = self.workers.setdefault(exe, [])
+            idle = [w for w in workers if not w.pending]
+            if idle:
+                return idle[0]
+            if len(workers) < self.size:
+                workers.append(
+                    PersistentScript([exe], cwd=self.cwd, timeout=self.timeout)
+                )
+                return workers[-1]
+            return min(workers, key=lambda w: len(w.pending))
+
+    def run(self, exe: str, args: List[str]) -> Tuple[int, str]:
+        """Returns the return code and stdout of one invocation of the script."""
+        try:
+            response = self._pick_worker(exe).request({"args": args})
+        except RuntimeError as e:
+            print(f"Error running {exe}: {e}")
+            return 1, ""
+        if "error" in response:
+            print(f"Error running {exe}: {response['error']}")
+            return int(response.get("returncode", 1)), response.get("stdout", "")
+        return int(response.get("returncode", 0)), response.get("stdout", "")
+
+    def close(self) -> None:
+        with self.lock:
+            for workers in self.workers.values():
+                for worker in workers:
+                    worker.close()
+            self.workers.clear()
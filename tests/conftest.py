@@ -0,0 +1,17 @@
+import os
+import sys
+import importlib.util
+
+# The repository is the pint_lib package itself, import it under that name
+# so the tests run against this checkout rather than an installed copy
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "pint_lib" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "pint_lib",
+        os.path.join(ROOT, "__init__.py"),
+        submodule_search_locations=[ROOT],
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["pint_lib"] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,370 @@
+import json
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from pint_lib.batch import BatchCollector, BatchPending
+from pint_lib.claude_engine import ClaudeEngine, ANTHROPIC_AVAILABLE
+from pint_lib.open_ai_engine import OpenAIEngine, OPENAI_AVAILABLE
+from pint_lib.model_data import ModelDataLoader
+from pint_lib.parse_papers import parse_papers, model_data as run_config
+
+# Three stages: b needs a, and c is skipped or not depending on b.  s is
+# always skipped, passing on the reply of a
+STAGED_ROWS = [
+    {"name": "a", "prompts": ["Summarise [paper]"]},
+    {"name": "s", "skipPrompt": "#yes", "skipTest": "is_yes", "prompts": ["Never"]},
+    {"name": "b", "prompts": ["Is [a] about health?"]},
+    {"name": "c", "skipPrompt": "#[b]", "skipTest": "is_no", "prompts": ["Why [a]"]},
+    {"name": "d", "prompts": ["Title of [paper]"]},
+]
+
+DOCUMENTS = {
+    "doc1.txt": "Aspirin and the heart, a medicine trial.",
+    "doc2.txt": "Migration of birds over the Alps.",
+    "doc3.txt": "Statins in elderly patients, another medicine study.",
+}
+
+
+def answer(prompt):
+    if prompt.startswith("Is "):
+        return "yes" if "medicine" in prompt else "no"
+    return f"<{prompt}>"
+
+
+def user_text(messages):
+    text = ""
+    for message in messages:
+        if message["role"] != "user":
+            continue
+        content = message["content"]
+        if isinstance(content, str):
+            text += content
+        else:
+            text += "".join(block["text"] for block in content)
+    return text
+
+
+class FakeProvider(BaseHTTPRequestHandler):
+    """
+    The Anthropic message batches and the OpenAI files and batches endpoints,
+    answering with answer().  Batches end on the first poll and list their
+    results in reverse order, with the requests whose prompt contains
+    "errored" failing.  Counts the interactive and batch requests.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        data = self.read_body()
+        if path == "/v1/messages":
+            self.state["counts"]["interactive"] += 1
+            return self.send(claude_message(json.loads(data)))
+        if path == "/v1/chat/completions":
+            self.state["counts"]["interactive"] += 1
+            return self.send(openai_completion(json.loads(data)))
+        if path == "/v1/messages/batches":
+            requests = json.loads(data)["requests"]
+            return self.send(self.claude_batch(requests))
+        if path == "/v1/files":
+            # the uploaded JSONL, out of the multipart body
+            lines = [
+                line
+                for line in data.decode().splitlines()
+                if line.startswith('{"custom_id"')
+            ]
+            file_id = self.new_id("file")
+            self.state["files"][file_id] = "\n".join(lines)
+            return self.send(
+                {
+                    "id": file_id,
+                    "object": "file",
+                    "bytes": len(data),
+                    "created_at": 0,
+                    "filename": "batch.jsonl",
+                    "purpose": "batch",
+                    "status": "processed",
+                }
+            )
+        if path == "/v1/batches":
+            return self.send(self.openai_batch(json.loads(data)))
+        self.send_error(404)
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:3] == ["v1", "messages", "batches"]:
+            batch = self.state["batches"][parts[3]]
+            if len(parts) == 5:
+                return self.send(batch["results"].encode(), "application/binary")
+            batch["processing_status"] = "ended"
+            batch["results_url"] = (
+                f"http://{self.headers['Host']}/v1/messages/batches/{parts[3]}/results"
+            )
+            return self.send({k: v for k, v in batch.items() if k != "results"})
+        if parts[:2] == ["v1", "batches"]:
+            batch = self.state["batches"][parts[2]]
+            batch["status"] = "completed"
+            return self.send(batch)
+        if parts[:2] == ["v1", "files"] and parts[-1] == "content":
+            return self.send(self.state["files"][parts[2]].encode())
+        self.send_error(404)
+
+    def new_id(self, prefix):
+        with self.server.lock:
+            self.state["next_id"] += 1
+            return f"{prefix}_{self.state['next_id']}"
+
+    def claude_batch(self, requests):
+        self.state["counts"]["batches"] += 1
+        self.state["counts"]["batch_requests"] += len(requests)
+        results = []
+        for request in reversed(requests):
+            if "errored" in user_text(request["params"]["messages"]):
+                result = {"type": "errored", "error": {"type": "error"}}
+            else:
+                result = {
+                    "type": "succeeded",
+                    "message": claude_message(request["params"]),
+                }
+            results.append({"custom_id": request["custom_id"], "result": result})
+        batch_id = self.new_id("msgbatch")
+        batch = {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "in_progress",
+            "request_counts": {
+                "processing": len(requests),
+                "succeeded": 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": "2024-01-01T00:00:00Z",
+            "expires_at": "2024-01-02T00:00:00Z",
+            "ended_at": None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": None,
+        }
+        self.state["batches"][batch_id] = dict(
+            batch, results="\n".join(json.dumps(r) for r in results)
+        )
+        return batch
+
+    def openai_batch(self, request):
+        lines = self.state["files"][request["input_file_id"]].splitlines()
+        self.state["counts"]["batches"] += 1
+        self.state["counts"]["batch_requests"] += len(lines)
+        results = []
+        for line in reversed(lines):
+            item = json.loads(line)
+            if "errored" in user_text(item["body"]["messages"]):
+                response = {"status_code": 500, "request_id": "r", "body": {}}
+            else:
+                response = {
+                    "status_code": 200,
+                    "request_id": "r",
+                    "body": openai_completion(item["body"]),
+                }
+            results.append(
+                {"id": "r", "custom_id": item["custom_id"], "response": response}
+            )
+        output_id = self.new_id("file")
+        self.state["files"][output_id] = "\n".join(json.dumps(r) for r in results)
+        batch_id = self.new_id("batch")
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": "24h",
+            "status": "validating",
+            "output_file_id": output_id,
+            "created_at": 0,
+        }
+        self.state["batches"][batch_id] = batch
+        return dict(batch, output_file_id=None)
+
+
+def claude_message(params):
+    return {
+        "id": "msg",
+        "type": "message",
+        "role": "assistant",
+        "model": params["model"],
+        "content": [{"type": "text", "text": answer(user_text(params["messages"]))}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": 2},
+    }
+
+
+def openai_completion(body):
+    return {
+        "id": "chatcmpl",
+        "object": "chat.completion",
+        "created": 0,
+        "model": body["model"],
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {
+                    "role": "assistant",
+                    "content": answer(user_text(body["messages"])),
+                },
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+    }
+
+
+@pytest.fixture
+def provider():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeProvider)
+    server.lock = threading.Lock()
+    server.state = {"counts": Counter(), "batches": {}, "files": {}, "next_id": 0}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+ENGINES = {
+    "claude": (ClaudeEngine, ANTHROPIC_AVAILABLE, ""),
+    "openai": (OpenAIEngine, OPENAI_AVAILABLE, "/v1"),
+}
+
+
+def api_url(provider, engine_name):
+    return f"http://127.0.0.1:{provider.server_port}{ENGINES[engine_name][2]}"
+
+
+def skip_if_unavailable(engine_name):
+    if not ENGINES[engine_name][1]:
+        pytest.skip(f"the {engine_name} client library is not installed")
+
+
+@pytest.mark.parametrize("engine_name", ["claude", "openai"])
+def test_run_batch_saves_replies_by_custom_id(tmp_path, provider, engine_name):
+    skip_if_unavailable(engine_name)
+    engine_class = ENGINES[engine_name][0]
+    model_data = ModelDataLoader()
+    model_data.data.update({"model_name": "test-model", "batch_poll_interval": "0"})
+    engine = engine_class(
+        model_data,
+        key="test",
+        api_url=api_url(provider, engine_name),
+        cache_folder=str(tmp_path / "cache"),
+    )
+
+    collector = BatchCollector()
+    engine.batch_collector = collector
+    prompts = ["Summarise first", "Summarise errored", "Is it medicine?"]
+    for prompt in prompts:
+        with pytest.raises(BatchPending):
+            engine.prompt(prompt, "system")
+    engine.batch_collector = None
+
+    assert engine.run_batch(collector.requests) == 2
+    assert provider.state["counts"]["batch_requests"] == 3
+
+    for prompt in ("Summarise first", "Is it medicine?"):
+        cached = engine.cache.get_cached_response("test-model", "system", prompt)
+        assert cached["message"]["content"] == answer(prompt)
+    assert engine.cache.get_cached_response("test-model", "system", prompts[1]) is None
+    assert provider.state["counts"]["interactive"] == 0
+
+
+def run_workflow(tmp_path, provider, engine_name, folder, **config):
+    run_folder = tmp_path / folder
+    (run_folder / "files").mkdir(parents=True)
+    for name, text in DOCUMENTS.items():
+        (run_folder / "files" / name).write_text(text, encoding="utf-8")
+    (run_folder / "ids.csv").write_text(
+        "filename\n" + "\n".join(DOCUMENTS) + "\n", encoding="utf-8"
+    )
+    rows = [
+        dict(
+            {"system": "", "includeOutput": "True", "skipPrompt": "", "skipTest": ""},
+            **row,
+        )
+        for row in STAGED_ROWS
+    ]
+    (run_folder / "prompts.json").write_text(json.dumps(rows), encoding="utf-8")
+    config = dict(
+        {
+            "model": engine_name,
+            "model_name": "test-model",
+            "api_key": "test",
+            "api_url": api_url(provider, engine_name),
+            "use_pubmed_api": "false",
+            "documents_data": "ids.csv",
+            "column_name": "filename",
+            "prompt_data": "prompts.json",
+            "files_folder": str(run_folder / "files"),
+            "cache_folder": str(run_folder / "cache" / "api"),
+            "self_data.data_cache_folder": str(run_folder / "cache" / "data"),
+            "output_folder": str(run_folder / "output"),
+            "error_file": str(run_folder / "error.log"),
+            "batch_poll_interval": "0",
+        },
+        **config,
+    )
+    config_file = run_folder / "config.json"
+    config_file.write_text(json.dumps(config), encoding="utf-8")
+
+    provider.state["counts"].clear()
+    # the loaded config is module state, kept from the previous run
+    run_config.data.clear()
+    parse_papers(config_file)
+    with open(run_folder / "output" / "output.json", encoding="utf-8") as f:
+        return json.load(f), dict(provider.state["counts"])
+
+
+@pytest.mark.parametrize("engine_name", ["claude", "openai"])
+@pytest.mark.parametrize("prompt_workers", ["1", "2"])
+def test_staged_sheet_in_batch_mode(tmp_path, provider, engine_name, prompt_workers):
+    skip_if_unavailable(engine_name)
+    expected, counts = run_workflow(tmp_path, provider, engine_name, "direct")
+    assert counts.get("batches", 0) == 0
+
+    output, counts = run_workflow(
+        tmp_path,
+        provider,
+        engine_name,
+        "batch",
+        batch_mode="true",
+        prompt_workers=prompt_workers,
+    )
+
+    assert output == expected
+    assert list(output) == list(DOCUMENTS)
+    assert "c" not in output["doc2.txt"]
+    assert "s" not in output["doc1.txt"]
+    # a and d together, then b, then c for the medicine documents,
+    # and nothing is left to send directly afterwards
+    assert counts["batches"] == 3
+    assert counts["batch_requests"] == 3 * 2 + 3 + 2
+    assert counts.get("interactive", 0) == 0
@@ -0,0 +1,37 @@
+from pint_lib.chunking import Chunker
+from pint_lib.model_data import ModelDataLoader
+from pint_lib.utils import estimate_tokens
+
+# One sentence with no boundary to cut at
+SENTENCE = " ".join(f"word{i:02d}" for i in range(40)) + "."
+
+
+def test_long_sentence_chunks_overlap():
+    chunks = Chunker(100, overlap=20).split_text(SENTENCE, 60)
+
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 60 for chunk in chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # each chunk starts with the last words of the one before
+        first_words = chunk[:14]
+        assert previous.endswith(first_words)
+    assert chunks[-1].endswith("word39.")
+
+
+def test_long_word_overlaps_in_characters():
+    word = "x" * 50 + "y" * 50
+    chunks = Chunker(100, overlap=10).split_text(word, 40)
+
+    assert chunks[1].startswith(chunks[0][-10:])
+
+
+def test_heuristic_tokens_are_counted_on_the_whole_chunk():
+    model_data = ModelDataLoader()
+    model_data.data.update({"max_prompt_tokens": 50, "chunk_overlap": 5})
+    chunker = Chunker.from_config(model_data, 1000)
+
+    chunks = chunker.split_text("a " * 300, chunker.max_size)
+
+    assert all(estimate_tokens(chunk) <= 50 for chunk in chunks)
+    # a short word is not counted as a whole token on top of its length
+    assert all(estimate_tokens(chunk) >= 45 for chunk in chunks[:-1])
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from pint_lib.parse_papers import merge_shards, model_data as run_config
+
+ROWS = {
+    "doc1.txt": {"a": "yes", "b": "first"},
+    "doc2.txt": {"a": "no", "b": "second"},
+    "doc3.txt": {"a": "yes", "b": "third"},
+}
+
+
+def test_merge_writes_parquet_in_input_order(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    prompts = [
+        {
+            "name": name,
+            "system": "",
+            "includeOutput": "True",
+            "skipPrompt": "",
+            "skipTest": "",
+            "prompts": [f"Answer [paper] {name}"],
+        }
+        for name in ("a", "b")
+    ]
+    (tmp_path / "prompts.json").write_text(json.dumps(prompts), encoding="utf-8")
+    (tmp_path / "ids.csv").write_text(
+        "filename\n" + "\n".join(ROWS) + "\n", encoding="utf-8"
+    )
+    output = tmp_path / "output"
+    output.mkdir()
+    # shard 0 has doc3, shard 1 the others
+    for shard, ids in ((0, ["doc3.txt"]), (1, ["doc2.txt", "doc1.txt"])):
+        with open(output / f"output_shard{shard}of2.json", "w") as f:
+            json.dump({pubmed_id: ROWS[pubmed_id] for pubmed_id in ids}, f)
+    config_file = tmp_path / "config.json"
+    config_file.write_text(
+        json.dumps(
+            {
+                "documents_data": "ids.csv",
+                "column_name": "filename",
+                "prompt_data": "prompts.json",
+                "output_folder": str(output),
+                "parquet_output": "true",
+                "error_file": str(tmp_path / "error.log"),
+            }
+        ),
+        encoding="utf-8",
+    )
+
+    run_config.data.clear()
+    merge_shards(config_file, 2)
+
+    rows = pq.read_table(output / "output.parquet").to_pylist()
+    assert rows == [dict({"filename": key}, **row) for key, row in ROWS.items()]
+    with open(output / "output.json", encoding="utf-8") as f:
+        assert list(json.load(f)) == list(ROWS)
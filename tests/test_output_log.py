@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from pint_lib.output_log import OutputLog, DONE, FAILED
+
+
+def write_log(path, ids, status=DONE, append=False):
+    with OutputLog(str(path), append=append) as log:
+        for document_id in ids:
+            log.append(document_id, status, {"a": document_id}, {"paper": "text"})
+
+
+def statuses(path):
+    return OutputLog.read(str(path))[2]
+
+
+def test_new_log_replaces_the_old_one_when_finished(tmp_path):
+    path = tmp_path / "output.jsonl"
+    write_log(path, ["1", "2"])
+    write_log(path, ["3"])
+
+    assert statuses(path) == {"3": DONE}
+    assert not os.path.exists(str(path) + ".partial")
+    assert OutputLog.latest(str(path)) == str(path)
+
+
+def test_interrupted_run_keeps_the_old_log(tmp_path):
+    path = tmp_path / "output.jsonl"
+    write_log(path, ["1", "2"])
+
+    with pytest.raises(KeyboardInterrupt):
+        with OutputLog(str(path)) as log:
+            log.append("3", DONE, {"a": "3"})
+            raise KeyboardInterrupt
+
+    assert statuses(path) == {"1": DONE, "2": DONE}
+    latest = OutputLog.latest(str(path))
+    assert latest == str(path) + ".partial"
+    assert statuses(latest) == {"3": DONE}
+
+
+def test_resume_carries_on_with_the_interrupted_log(tmp_path):
+    path = tmp_path / "output.jsonl"
+    write_log(path, ["1", "2"])
+    with pytest.raises(KeyboardInterrupt):
+        with OutputLog(str(path)) as log:
+            log.append("3", FAILED)
+            raise KeyboardInterrupt
+
+    write_log(path, ["4"], append=True)
+
+    assert statuses(path) == {"3": FAILED, "4": DONE}
+    assert not os.path.exists(str(path) + ".partial")
+
+
+def test_resume_appends_to_a_finished_log(tmp_path):
+    path = tmp_path / "output.jsonl"
+    write_log(path, ["1"])
+    write_log(path, ["2"], append=True)
+
+    outputs, debug, status = OutputLog.read(str(path))
+    assert status == {"1": DONE, "2": DONE}
+    assert dict(outputs.items()) == {"1": {"a": "1"}, "2": {"a": "2"}}
+    assert debug["2"] == {"paper": "text"}
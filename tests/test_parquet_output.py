@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+from pint_lib.parquet_output import ParquetOutput
+
+
+def write_parquet(path, ids):
+    with ParquetOutput(str(path), "id", ["a"], row_group=1) as parquet:
+        for document_id in ids:
+            parquet.append(document_id, {"a": document_id})
+
+
+def test_new_output_replaces_the_old_one_when_finished(tmp_path):
+    path = tmp_path / "output.parquet"
+    write_parquet(path, ["1", "2"])
+    write_parquet(path, ["3"])
+
+    assert pq.read_table(path).to_pylist() == [{"id": "3", "a": "3"}]
+    assert not os.path.exists(str(path) + ".partial")
+
+
+def test_interrupted_run_keeps_the_old_output(tmp_path):
+    path = tmp_path / "output.parquet"
+    write_parquet(path, ["1"])
+
+    with pytest.raises(KeyboardInterrupt):
+        with ParquetOutput(str(path), "id", ["a"]) as parquet:
+            parquet.append("2", {"a": "2"})
+            raise KeyboardInterrupt
+
+    assert pq.read_table(path).to_pylist() == [{"id": "1", "a": "1"}]
+    partial = pq.read_table(str(path) + ".partial").to_pylist()
+    assert partial == [{"id": "2", "a": "2"}]
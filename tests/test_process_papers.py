@@ -0,0 +1,221 @@
+import json
+import sys
+import time
+
+import pytest
+
+from pint_lib.model_data import ModelDataLoader
+from pint_lib.prompt_data import PromptDataParser
+from pint_lib.workflow_context import WorkflowContext
+from pint_lib.process_papers import process_document, get_text_from_prompt
+
+PAPER = "Aspirin lowers the risk of heart attacks in adults."
+
+# Row 2 is skipped and passes on the reply of row 1, row 4 is not skipped
+SKIP_ROWS = [
+    {
+        "name": "a",
+        "includeOutput": "True",
+        "skipPrompt": "",
+        "skipTest": "",
+        "prompts": ["Summarise [paper]"],
+    },
+    {
+        "name": "b",
+        "includeOutput": "True",
+        "skipPrompt": "#yes",
+        "skipTest": "is_yes",
+        "prompts": ["Never sent [paper]"],
+    },
+    {
+        "name": "c",
+        "includeOutput": "True",
+        "skipPrompt": "",
+        "skipTest": "",
+        "prompts": ["Topic of [paper]"],
+    },
+    {
+        "name": "d",
+        "includeOutput": "True",
+        "skipPrompt": "Is [c] long?",
+        "skipTest": "is_yes",
+        "prompts": ["Expand [c]", "Shorter: [reply]"],
+    },
+    {
+        "name": "e",
+        "includeOutput": "True",
+        "skipPrompt": "",
+        "skipTest": "",
+        "prompts": ["prev [reply] r2 [reply_2]"],
+    },
+]
+
+
+class EchoEngine:
+    """Answers every prompt with its own text, after a delay that varies by prompt."""
+
+    batch_collector = None
+
+    def prompt(self, prompt, system="", prefix=""):
+        time.sleep(0.01 * (len(prompt) % 4))
+        if prompt.startswith("Is "):
+            return "no"
+        return f"<{prompt}>"
+
+
+def load_workflow(tmp_path, rows, **config):
+    prompt_file = tmp_path / "prompts.json"
+    prompt_file.write_text(
+        json.dumps([dict({"system": ""}, **row) for row in rows]), encoding="utf-8"
+    )
+    config_file = tmp_path / "config.json"
+    config_file.write_text(
+        json.dumps(
+            dict(
+                {
+                    "prompt_data": "prompts.json",
+                    "error_file": str(tmp_path / "error.log"),
+                },
+                **config,
+            )
+        ),
+        encoding="utf-8",
+    )
+    model_data = ModelDataLoader()
+    model_data.load_model_data(config_file)
+    parser = PromptDataParser()
+    parser.load_prompt_data(model_data)
+    ctx = WorkflowContext(model_data)
+    ctx.llm_engine = EchoEngine()
+    return ctx, model_data, parser
+
+
+def run_document(tmp_path, rows, prompt_workers):
+    ctx, model_data, parser = load_workflow(
+        tmp_path, rows, prompt_workers=str(prompt_workers)
+    )
+    doc_ctx = ctx.document_context()
+    document = {"text": PAPER, "sections": {"paper": PAPER}}
+    output = process_document("doc1", document, doc_ctx, model_data, parser)
+    return output, doc_ctx
+
+
+def test_skip_rows_depend_on_the_previous_row(tmp_path):
+    _, _, parser = load_workflow(tmp_path, SKIP_ROWS)
+    depends_on = [line["dependsOn"] for line in parser.get_prompt_data()]
+    assert depends_on == [[], [0], [], [2], [0, 1, 2, 3]]
+
+
+@pytest.mark.parametrize("prompt_workers", [2, 4])
+def test_concurrent_rows_match_sequential_with_skip_rows(tmp_path, prompt_workers):
+    sequential, seq_ctx = run_document(tmp_path, SKIP_ROWS, 1)
+    concurrent, con_ctx = run_document(tmp_path, SKIP_ROWS, prompt_workers)
+
+    assert sequential is not None
+    assert "b" not in sequential
+    assert concurrent == sequential
+    assert list(concurrent) == list(sequential)
+    assert con_ctx.data_store == seq_ctx.data_store
+    assert con_ctx.ordered_column_list == seq_ctx.ordered_column_list
+
+
+@pytest.mark.parametrize("prompt_workers", [1, 2])
+def test_first_row_skipped(tmp_path, prompt_workers):
+    rows = [
+        {
+            "name": "a",
+            "includeOutput": "True",
+            "skipPrompt": "#yes",
+            "skipTest": "is_yes",
+            "prompts": ["Never sent"],
+        },
+        {
+            "name": "b",
+            "includeOutput": "True",
+            "skipPrompt": "",
+            "skipTest": "",
+            "prompts": ["Summarise [paper]"],
+        },
+    ]
+    output, _ = run_document(tmp_path, rows, prompt_workers)
+    assert output == {"b": f"<Summarise {PAPER}>"}
+
+
+@pytest.mark.parametrize("persistent", [False, True])
+def test_script_arguments_keep_quotes_in_values(tmp_path, persistent):
+    scripts = tmp_path / "scripts"
+    scripts.mkdir()
+    if persistent:
+        source = (
+            "import json, sys\n"
+            "for line in sys.stdin:\n"
+            "    call = json.loads(line)\n"
+            "    print(json.dumps({'id': call['id'], 'returncode': 0,"
+            " 'stdout': json.dumps(call['args'])}), flush=True)\n"
+        )
+    else:
+        source = "import json, sys\nprint(json.dumps(sys.argv[1:]))\n"
+    script = scripts / "args.py"
+    script.write_text(f"#!{sys.executable}\n{source}", encoding="utf-8")
+    script.chmod(0o755)
+
+    ctx, model_data, _ = load_workflow(
+        tmp_path,
+        SKIP_ROWS,
+        script_folder=str(scripts),
+        persistent_scripts="args.py" if persistent else "",
+    )
+    ctx.data_store = {"paper": 'it\'s a "quoted" paper', "reply": 'say "hi'}
+    try:
+        result = get_text_from_prompt(
+            "#!args.py \"[reply]\" --paper=[paper] 'two words'", "", ctx, model_data
+        )
+    finally:
+        ctx.script_pool.close()
+    assert json.loads(result) == [
+        'say "hi',
+        '--paper=it\'s a "quoted" paper',
+        "two words",
+    ]
+
+
+@pytest.mark.parametrize("prompt_workers", [1, 2])
+def test_skip_test_reads_an_earlier_script_row(tmp_path, prompt_workers):
+    script = tmp_path / "fail.sh"
+    script.write_text("#!/bin/sh\necho failed\nexit 3\n", encoding="utf-8")
+    script.chmod(0o755)
+    rows = [
+        {
+            "name": "a",
+            "includeOutput": "True",
+            "skipPrompt": "",
+            "skipTest": "",
+            "prompts": ["#!fail.sh"],
+        },
+        {
+            "name": "b",
+            "includeOutput": "True",
+            "skipPrompt": "",
+            "skipTest": "",
+            "prompts": ["Summarise [paper]"],
+        },
+        {
+            "name": "c",
+            "includeOutput": "True",
+            "skipPrompt": "#",
+            "skipTest": "is_script_error",
+            "prompts": ["Never sent"],
+        },
+    ]
+    ctx, model_data, parser = load_workflow(
+        tmp_path,
+        rows,
+        prompt_workers=str(prompt_workers),
+        script_folder=str(tmp_path),
+    )
+    assert parser.get_prompt_data()[2]["dependsOn"] == [0, 1]
+
+    doc_ctx = ctx.document_context()
+    document = {"text": PAPER, "sections": {"paper": PAPER}}
+    output = process_document("doc1", document, doc_ctx, model_data, parser)
+    assert output == {"a": "failed", "b": f"<Summarise {PAPER}>"}
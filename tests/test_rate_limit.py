@@ -0,0 +1,45 @@
+import pytest
+
+from pint_lib.rate_limit import RateLimiter, get_rate_limiter
+
+
+def test_headers_count_the_requests_still_in_flight():
+    limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=1000)
+    for _ in range(3):
+        limiter.acquire(100)
+
+    # the provider counted the first request and 4 from elsewhere, not the
+    # two still in flight
+    limiter.update_from_headers(
+        {
+            "x-ratelimit-remaining-requests": "5",
+            "x-ratelimit-remaining-tokens": "500",
+        },
+        100,
+    )
+
+    assert limiter.in_flight_requests == 2
+    assert limiter.requests == pytest.approx(3, abs=0.01)
+    assert limiter.tokens == pytest.approx(300, abs=1)
+
+
+def test_headers_above_the_local_budget_leave_it():
+    limiter = RateLimiter(requests_per_minute=10)
+    for _ in range(3):
+        limiter.acquire()
+    limiter.release()
+
+    limiter.update_from_headers({"x-ratelimit-remaining-requests": "9"})
+
+    assert limiter.in_flight_requests == 1
+    assert limiter.requests == pytest.approx(7, abs=0.01)
+
+
+def test_shared_limiter_warns_about_other_limits(capsys):
+    first = get_rate_limiter(("test", "model"), 10, 1000)
+    assert get_rate_limiter(("test", "model"), "10", "1000") is first
+    assert capsys.readouterr().out == ""
+
+    assert get_rate_limiter(("test", "model"), 20, None) is first
+    assert "ignoring 20.0 and None" in capsys.readouterr().out
+    assert first.requests_per_minute == 10
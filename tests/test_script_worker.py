@@ -0,0 +1,76 @@
+import asyncio
+import sys
+
+import pytest
+
+from pint_lib.script_worker import PersistentScript, ScriptPool
+
+# Echoes each request's text back, and never answers "hang"
+WORKER = """
+import json, sys
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["text"] != "hang":
+        print(json.dumps({"id": request["id"], "content": request["text"]}), flush=True)
+"""
+
+# A persistent #! script that prints its arguments, and never answers "hang"
+POOL_SCRIPT = """#!{python}
+import json, sys
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["args"] != ["hang"]:
+        stdout = " ".join(request["args"])
+        reply = {{"id": request["id"], "returncode": 0, "stdout": stdout}}
+        print(json.dumps(reply), flush=True)
+"""
+
+
+@pytest.fixture
+def worker(tmp_path):
+    script = tmp_path / "worker.py"
+    script.write_text(WORKER, encoding="utf-8")
+    worker = PersistentScript([sys.executable, str(script)], timeout=0.5)
+    yield worker
+    worker.close()
+
+
+def test_request_gets_its_reply(worker):
+    assert worker.request({"text": "a"})["content"] == "a"
+
+
+def test_timeout_restarts_the_script(worker):
+    assert worker.request({"text": "a"})["content"] == "a"
+    first = worker.process
+
+    with pytest.raises(RuntimeError, match="did not reply"):
+        worker.request({"text": "hang"})
+    assert first.wait(timeout=5) != 0
+    assert not worker.pending
+
+    assert worker.request({"text": "b"})["content"] == "b"
+    assert worker.process is not first
+
+
+def test_timeout_fails_the_other_requests_in_flight(worker):
+    other = worker.submit({"text": "hang"})
+
+    with pytest.raises(RuntimeError, match="did not reply"):
+        asyncio.run(worker.arequest({"text": "hang"}))
+    with pytest.raises(RuntimeError, match="did not reply"):
+        other.result(timeout=5)
+
+    assert asyncio.run(worker.arequest({"text": "c"}))["content"] == "c"
+
+
+def test_pool_restarts_a_script_that_times_out(tmp_path):
+    script = tmp_path / "lookup.py"
+    script.write_text(POOL_SCRIPT.format(python=sys.executable), encoding="utf-8")
+    script.chmod(0o755)
+    pool = ScriptPool(1, timeout=0.5)
+    try:
+        assert pool.run(str(script), ["a", "b"]) == (0, "a b")
+        assert pool.run(str(script), ["hang"]) == (1, "")
+        assert pool.run(str(script), ["c"]) == (0, "c")
+    finally:
+        pool.close()
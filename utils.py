@@ -1,6 +1,8 @@
 import traceback
+import threading
 import json
 import re
+from typing import List, Dict, Optional
 
 
 def log_traceback(logfile="error.log"):
@@ -101,3 +103,64 @@ def isCommaSeparatedList(answer, param=None):
 
 def isNotCommaSeparatedList(answer, param=None):
     return not isCommaSeparatedList(answer, param)
+
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough token count for budgeting requests, about 4 characters per token
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size) -> int:
+    # Sizes are given in bytes, or with a K/M/G/T suffix, e.g. "10GB" or "512M"
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size '{size}', use e.g. 500MB or 10GB")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def build_messages(
+    prompt: str, system: str = "", prefix: str = ""
+) -> List[Dict[str, str]]:
+    """
+    Chat messages for a prompt.  A prefix (with prompt_caching, the document
+    text that is the same for every row) is sent as its own first user
+    message, so the provider can cache it across prompts.
+    """
+    messages = [{"role": "system", "content": system}]
+    if prefix:
+        messages.append({"role": "user", "content": prefix})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+class UsageCounter:
+    """Totals of the token usage reported by the provider, shared by threads."""
+
+    FIELDS = ("requests", "input", "output", "cache_read", "cache_write")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        self.lock = threading.Lock()
+
+    def add(self, **counts: Optional[int]) -> None:
+        with self.lock:
+            self.counts["requests"] += 1
+            for field, count in counts.items():
+                self.counts[field] += count or 0
+
+    def summary(self) -> str:
+        with self.lock:
+            counts = dict(self.counts)
+        return (
+            f"{counts['requests']} requests, {counts['input']} uncached input "
+            f"tokens, {counts['cache_read']} read from and {counts['cache_write']} "
+            f"written to the provider cache, {counts['output']} output tokens"
+        )
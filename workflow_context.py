@@ -1,13 +1,45 @@
+import copy
 import sys
+import hashlib
+import threading
+from typing import Tuple
 
 from .utils import isYes
 from .claude_engine import ClaudeEngine
 from .open_ai_engine import OpenAIEngine
 from .external_engine import ExternalEngine
+from .script_worker import ScriptPool, DEFAULT_SCRIPT_TIMEOUT
+from .chunking import Chunker
+from .document_store import DocumentStore
+from .replay import Replay
+from .output_log import DebugCapture
 
 
 DEFAULT_MAX_PROMPT_LENGTH = 100000
 DEFAULT_MAX_TOKENS = 4096
+DEFAULT_WORKERS = 1
+DEFAULT_PROMPT_WORKERS = 1
+DEFAULT_CHUNK_WORKERS = 1
+DEFAULT_PREFETCH = 0
+
+
+def parse_shard(shard) -> Tuple[int, int]:
+    """Parses a shard given as "i/N", where i counts from 0."""
+    if not shard:
+        return 0, 1
+    try:
+        index, count = (int(part) for part in str(shard).split("/"))
+    except ValueError as e:
+        raise ValueError(f"shard must be given as i/N, not '{shard}'") from e
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"shard index must be between 0 and {count - 1}: '{shard}'")
+    return index, count
+
+
+def shard_of(pubmed_id: str, shard_count: int) -> int:
+    # md5 rather than hash() so every process assigns the same shard
+    digest = hashlib.md5(str(pubmed_id).encode()).hexdigest()
+    return int(digest, 16) % shard_count
 
 
 class WorkflowContext:
@@ -27,7 +59,32 @@ class WorkflowContext:
         self.max_prompt_length = int(
             model_data.get("max_prompt_length", DEFAULT_MAX_PROMPT_LENGTH)
         )
+        # Splits prompts longer than max_prompt_length characters,
+        # or max_prompt_tokens tokens
+        self.chunker = Chunker.from_config(model_data, self.max_prompt_length)
         self.max_doc_length = int(model_data.get("max_document_length", sys.maxsize))
+        # Number of documents processed in parallel
+        self.workers = max(1, int(model_data.get("workers", DEFAULT_WORKERS)))
+        # Number of independent prompt rows of one document run in parallel
+        self.prompt_workers = max(
+            1, int(model_data.get("prompt_workers", DEFAULT_PROMPT_WORKERS))
+        )
+        # Number of documents fetched and parsed ahead in the background
+        self.prefetch = max(0, int(model_data.get("prefetch", DEFAULT_PREFETCH)))
+        # `#!` scripts that are started once and kept running, and how many
+        # copies of each run at the same time
+        persistent_scripts = model_data.get("persistent_scripts", [])
+        if isinstance(persistent_scripts, str):
+            persistent_scripts = persistent_scripts.split()
+        self.persistent_scripts = set(persistent_scripts)
+        self.script_pool = ScriptPool(
+            max(1, int(model_data.get("script_workers", self.workers))),
+            timeout=float(model_data.get("script_timeout", DEFAULT_SCRIPT_TIMEOUT)),
+        )
+        # Number of chunks of a split prompt sent to the llm at once
+        self.chunk_workers = max(
+            1, int(model_data.get("chunk_workers", DEFAULT_CHUNK_WORKERS))
+        )
 
         # Responses are stored so that they are not repeated later
         # If you want to clear the cache, delete the cache folder, or you can change the key in the specific api file
@@ -40,6 +97,14 @@ class WorkflowContext:
         self.data_cache_folder = model_data.get(
             "self_data.data_cache_folder", model_data.resolve_path("cache/data")
         )
+        # "sqlite" keeps fetched documents, raw and parsed, in one indexed file
+        # instead of a JSON file per ID
+        self.document_store = None
+        store = str(model_data.get("document_store", "files")).lower()
+        if store == "sqlite":
+            self.document_store = DocumentStore(self.data_cache_folder)
+        elif store != "files":
+            raise ValueError(f"Unknown document_store '{store}', use files or sqlite")
 
         self.which_api = model_data.get("model")
         self.api_key = model_data.get("api_key")
@@ -49,20 +114,112 @@ class WorkflowContext:
         # There is an alternative to use a local script to get pubmed data
         self.use_pubmed_api = isYes(model_data.get("use_pubmed_api", "true"))
         self.use_pubmed_search = isYes(model_data.get("use_pubmed_search", "false"))
+        # Send prompts through the provider batch API, one workflow stage at a time
+        self.batch_mode = isYes(model_data.get("batch_mode", "false"))
+        # Offline replay from the caches, "fail" or "mark" on a cache miss
+        replay = str(model_data.get("replay", "off")).lower()
+        self.replay = None if replay in ("off", "false", "no", "") else Replay(replay)
+        # Send the document text first, the same for every row, so the
+        # provider can cache it, followed by the row's prompt
+        self.prompt_caching = isYes(model_data.get("prompt_caching", "false"))
+        prompt_cache_keys = model_data.get("prompt_cache_keys", ["paper"])
+        if isinstance(prompt_cache_keys, str):
+            prompt_cache_keys = prompt_cache_keys.replace(",", " ").split()
+        self.prompt_cache_keys = list(prompt_cache_keys)
+        # Only process the IDs hashed to shard i of N, given as "i/N"
+        self.shard_index, self.shard_count = parse_shard(model_data.get("shard"))
+        # Skip the IDs already in the output log of an earlier run, and
+        # optionally run the ones that failed again
+        self.resume = isYes(model_data.get("resume", "false"))
+        self.retry_failed = isYes(model_data.get("retry_failed", "false"))
+        self.finished = set()
+        # What the debug output keeps of each document's data store
+        self.debug_capture = DebugCapture.from_config(model_data)
 
         # Runtime state
         self.data_store = {}
         self.output_data = {}
         self.final_output = {}
         self.debug = {}
+        # number of documents with an output row, the rows are in the output log
+        self.output_count = 0
         self.ordered_column_list = []
         self.reply_count = 0
         self.script_returncode = 0
+        # done, failed or skipped, set while a document is processed
+        self.status = None
         self.llm_engine = None
+        self.lock = threading.Lock()
 
     def reinit(self, model_data) -> None:
         self.__init__(model_data)
 
+    def in_shard(self, pubmed_id: str) -> bool:
+        return shard_of(pubmed_id, self.shard_count) == self.shard_index
+
+    def document_context(self) -> "WorkflowContext":
+        """
+        Returns a copy of this context with its own per-document state.
+        Config and the llm engine are shared, everything process_document
+        writes to is private, so documents can be processed concurrently.
+        """
+        doc_ctx = copy.copy(self)
+        doc_ctx.data_store = {}
+        doc_ctx.output_data = {}
+        doc_ctx.final_output = {}
+        doc_ctx.debug = {}
+        doc_ctx.ordered_column_list = []
+        doc_ctx.reply_count = 0
+        doc_ctx.script_returncode = 0
+        doc_ctx.status = None
+        return doc_ctx
+
+    def merge_document(self, doc_ctx) -> None:
+        """
+        Merges the results of a document context back into this one.  The
+        rows themselves are written to the output log, only their columns
+        and number are kept.
+        """
+        with self.lock:
+            self.output_count += len(doc_ctx.final_output)
+            for column in doc_ctx.ordered_column_list:
+                if column not in self.ordered_column_list:
+                    self.ordered_column_list.append(column)
+
+    def line_context(self) -> "WorkflowContext":
+        """
+        Returns a copy of this document context for running a single prompt
+        row, starting from a snapshot of the current data store.
+        """
+        line_ctx = copy.copy(self)
+        line_ctx.data_store = dict(self.data_store)
+        line_ctx.output_data = {}
+        line_ctx.ordered_column_list = []
+        line_ctx.reply_count = 0
+        return line_ctx
+
+    def merge_line(self, line_ctx, name: str, result) -> None:
+        """
+        Merges a row run in a line context back into this one, renumbering
+        its replies as if the row had run straight after the previous one.
+        """
+        if line_ctx.reply_count > 0:
+            self.data_store["reply"] = line_ctx.data_store["reply"]
+            for n in range(1, line_ctx.reply_count + 1):
+                self.reply_count += 1
+                self.data_store[f"reply_{self.reply_count}"] = line_ctx.data_store[
+                    f"reply_{n}"
+                ]
+            if result:
+                self.data_store[name] = result
+
+        self.output_data.update(line_ctx.output_data)
+        for column in line_ctx.ordered_column_list:
+            if column not in self.ordered_column_list:
+                self.ordered_column_list.append(column)
+        if line_ctx.script_returncode != 0:
+            self.script_returncode = line_ctx.script_returncode
+
     def setup_llm_engine(self, model_data) -> None:
         engine_kwargs = {
             "model_data": model_data,
@@ -81,3 +238,4 @@ class WorkflowContext:
             self.llm_engine = OpenAIEngine(**engine_kwargs)
         elif api_name.startswith(("external", "local", "ollama")):
             self.llm_engine = ExternalEngine(**engine_kwargs)
+        self.llm_engine.replay = self.replay